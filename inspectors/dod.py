@@ -3,7 +3,6 @@
 import datetime
 from urllib.parse import urljoin, urlencode
 import re
-import os
 import logging
 from utils import utils, inspector
 
@@ -16,9 +15,12 @@ archive = 1986
 #
 #   report_id: limit to a particular report ID, skip others.
 #
-#   skip_downloaded: skip over any reports whose PDFs have been downloaded.
+#   skip_downloaded: skip over any reports that have already been saved.
 #      useful for resuming large fetches without making needless HTTP requests.
 #
+#   stop_at_known: stop paging through an office's reports once a whole page
+#      is made up of reports that have already been saved.
+#
 #   topics - limit reports fetched to one or more office, comma-separated.
 #            e.g. "IE,ISPA". These are the offices/"components" defined by the
 #            site. Defaults to all offices. (NOTE: this parameter is named
@@ -152,8 +154,12 @@ def run(options):
     # Default to all offices, whee!
     only = list(OFFICES.keys())
 
-  for url in urls_for(options, only):
+  stopped_offices = set()
+  for office, url in urls_for(options, only):
+    if office in stopped_offices:
+      continue
     page = utils.beautifulsoup_from_url(url)
+    listing = inspector.ListingPage('dod', options)
 
     report_table = page.select('table[summary~="reports"]')[0]
     for tr in report_table.select('tr')[1:]:
@@ -161,12 +167,16 @@ def run(options):
       if len(tds) == 1:
         # Page has no reports, simply a "No Data" indication for these dates.
         break
-      report = report_from(tds, options)
+      report = report_from(tds, options, listing)
       if report:
         inspector.save_report(report)
 
+    if listing.all_known():
+      logging.warn("[%s] Every report on this page is known, stopping." % office)
+      stopped_offices.add(office)
+
 
-def report_from(tds, options):
+def report_from(tds, options, listing):
   report = {
     'inspector': 'dod',
     'inspector_url': 'http://www.dodig.mil/',
@@ -198,18 +208,10 @@ def report_from(tds, options):
   if only_id and (only_id != report_id):
     return
 
-  # helper: use --skip_downloaded to skip reports whose PDFs are on disk
+  # helper: use --skip_downloaded to skip reports that are already saved
   #   (drastically reduces calls to DOD landing pages)
-  if options.get('skip_downloaded'):
-    pdf_path = inspector.path_for({
-      'report_id': report_id,
-      'year': str(published_date.year),
-      'inspector': 'dod'
-    }, 'pdf')
-
-    if os.path.exists(os.path.join(utils.data_dir(), pdf_path)):
-      logging.warn("\tSkipping previously downloaded report, as asked.")
-      return
+  if listing.skip_known(report_id=report_id, landing_url=landing_url):
+    return
 
   report_url, summary, maybe_unreleased, skip = fetch_from_landing_page(landing_url)
 
@@ -340,12 +342,12 @@ def urls_for(options, only):
 
     query_string = urlencode(params)
     url = '{0}?{1}'.format(BASE_URL, query_string)
-    yield url
+    yield office, url
 
     page = utils.beautifulsoup_from_url(url)
 
     for url in get_pagination_urls(page):
-      yield url
+      yield office, url
 
 
 def get_pagination_urls(page):
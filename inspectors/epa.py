@@ -10,6 +10,8 @@ archive = 1996
 
 # options:
 #   standard since/year options for a year range to fetch from.
+#
+#   skip_downloaded - skip the landing pages of reports that are already saved.
 
 RE_YEAR = re.compile(r'\d{4} (?:OIG )?Reports')
 RE_DATE = re.compile('(?:(?:Jan|January|JANUARY|Feb|February|FEBRUARY|Mar|'
@@ -162,6 +164,8 @@ def report_from_table(tds, published_on_dt, base_url):
     report['summary_url'] = report_url
   elif not report_url.endswith(".pdf"):
     report['landing_url'] = report_url
+    if inspector.skip_known('epa', report_id=report_id, landing_url=report_url):
+      return
     landing_page = utils.beautifulsoup_from_url(report_url)
     doc_links = landing_page.select("span.file a.file-link")
     for doc_link in doc_links:
@@ -5,7 +5,7 @@ import logging
 import json
 import os
 import re
-from urllib.parse import urljoin
+from urllib.parse import urljoin, urlparse, parse_qs
 
 from utils import utils, inspector, admin
 
@@ -40,6 +40,8 @@ http://www.gao.gov/browse/agency/Executive
 # options:
 #   standard since/year options for a year range to fetch from.
 #
+#   rows - how many reports to ask for per listing page, defaults to 50.
+#
 # Notes for IG's web team:
 # Not sure if the gao.gov/api/ interface is documented anywhere?
 # It seems hit-or-miss because only one unpredictable version of
@@ -49,6 +51,12 @@ http://www.gao.gov/browse/agency/Executive
 # pages instead where possible here.
 
 
+DEFAULT_ROWS = 50
+PAGES_PER_BATCH = 32
+# tries at a listing page before giving up on the run
+MAX_PAGE_ATTEMPTS = 3
+
+
 def run(options):
 
   scrape_reports(options)
@@ -59,7 +67,7 @@ def scrape_reports(options):
   """Pull reports from "Reports and Testimonies - Browse by date" web page."""
 
   REPORTS_URL = 'http://www.gao.gov/browse/date/custom?adv_begin_date=01/01/' +\
-    '%s&adv_end_date=12/31/%s&rows=50&o=%s' # % (year, year, offset)
+    '%s&adv_end_date=12/31/%s&rows=%s&o=%s' # % (year, year, rows, offset)
   archive = 1970
   # Amazingly, reports go back to 1940, though those are unlikely to be
   # legible enough to OCR. Also very cool, even 1950s-era reports seem to have
@@ -67,25 +75,78 @@ def scrape_reports(options):
   # General Accounting Office back then and less oversighty.
 
   year_range = inspector.year_range(options, archive)
-  for year in year_range:
-    is_next_page = True
-    offset = 0
-    while is_next_page:
-      doc = utils.beautifulsoup_from_url(
-        REPORTS_URL % (year, year, offset))
-      results = doc.select("div.listing")
-      for result in results:
-        report = process_report(result, year_range)
-        if report:
-          inspector.save_report(report)
-      page_links = doc.select("a.non-current_page")
-      if len(page_links) and page_links[-1].text.startswith('Next'):
-        offset += 50
-      else:
-        is_next_page = False
-
-
-def process_report(result, year_range):
+  rows = int(options.get('rows') or DEFAULT_ROWS)
+
+  # Start with the first page of every year. Each page's pagination links
+  # tell us which other offsets exist for its year, and those are queued up
+  # behind it. Pages are fetched concurrently, PAGES_PER_BATCH at a time and
+  # across all years, which also keeps the number of parsed pages in memory
+  # down.
+  pending = [(year, 0) for year in year_range]
+  queued = set(pending)
+  attempts = {}
+  while pending:
+    batch, pending = pending[:PAGES_PER_BATCH], pending[PAGES_PER_BATCH:]
+    urls = {}
+    for year, offset in batch:
+      urls[REPORTS_URL % (year, year, rows, offset)] = (year, offset)
+    docs = utils.beautifulsoups_from_urls(urls.keys())
+
+    for url, (year, offset) in sorted(urls.items(), key=lambda item: item[1]):
+      doc = docs[url]
+      if not doc:
+        # a missing page would also hide the offsets it links to, so try
+        # again later in the crawl, and fail the run if it never comes back
+        attempts[url] = attempts.get(url, 1) + 1
+        if attempts[url] > MAX_PAGE_ATTEMPTS:
+          raise Exception("Couldn't fetch GAO listing page after %i tries: %s" %
+                          (MAX_PAGE_ATTEMPTS, url))
+        logging.warn("Retrying GAO listing page later: %s" % url)
+        pending.append((year, offset))
+        continue
+      save_reports_from(doc, year_range)
+
+      for next_offset in offsets_from(doc, offset, rows):
+        if (year, next_offset) not in queued:
+          queued.add((year, next_offset))
+          pending.append((year, next_offset))
+
+
+# offsets of the other pages of a year's listing that this page links to
+def offsets_from(doc, offset, rows):
+  offsets = set()
+  for link in doc.select("a.non-current_page"):
+    query = parse_qs(urlparse(link.get('href', '')).query)
+    if query.get('o'):
+      offsets.add(int(query['o'][0]))
+    elif link.text.startswith('Next'):
+      offsets.add(offset + rows)
+  return offsets
+
+
+# Fetch the API details for every report on a listing page at once, then
+# hand each report to save_report (and so the save pipeline).
+def save_reports_from(doc, year_range):
+  results = doc.select("div.listing")
+  api_bodies = utils.fetch_many([api_url_for(result) for result in results])
+  for result in results:
+    report = process_report(result, year_range, api_bodies)
+    if report:
+      inspector.save_report(report)
+
+
+def api_url_for(result):
+  pdf_links = result.find_all('li', {'class': 'pdf-link'})
+  # Last PDF is full report. First one could be Highlights.
+  try:  # get the ID from one of the filenames, minus the extension
+    api_id = os.path.splitext(os.path.basename(pdf_links[-1].a['href']))[0]
+  except Exception:  # very old reports are sometimes different
+    api_id = os.path.splitext(os.path.basename(result.a['href']))[0]
+  api_id = api_id.lstrip('0')
+  return "http://www.gao.gov/api/id/%s" % api_id
+
+
+def process_report(result, year_range, api_bodies=None):
 
   """Use the report ID obtained from HTML to hit GAO's API"""
   # <a href="/assets/690/685452.pdf">View Report (PDF, 8 pages)</a>
@@ -125,19 +186,17 @@ def process_report(result, year_range):
       highlights_url = urljoin('https://www.gao.gov', link.a['href'])
     if 'Accessible' in link.a.string:
       accessible_url = urljoin('https://www.gao.gov', link.a['href'])
-  # Last PDF is full report. First one could be Highlights.
-  try:  # get the ID from one of the filenames, minus the extension
-    api_id = os.path.splitext(os.path.basename(pdf_links[-1].a['href']))[0]
-  except Exception:  # very old reports are sometimes different
-    api_id = os.path.splitext(os.path.basename(result.a['href']))[0]
-  api_id = api_id.lstrip('0')
+  api_url = api_url_for(result)
 
   if not landing_url and not report_url:
-    logging.debug("[%s] No landing URL or PDF, skipping..." % api_id)
+    logging.debug("[%s] No landing URL or PDF, skipping..." % api_url)
     return None
 
-  api_url = "http://www.gao.gov/api/id/%s" % api_id
-  json_response = json.loads(utils.download(api_url))
+  if api_bodies and api_bodies.get(api_url):
+    api_body = api_bodies[api_url]
+  else:
+    api_body = utils.download(api_url)
+  json_response = json.loads(api_body)
   if not json_response:
     return None
   details = json_response[0]
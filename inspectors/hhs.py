@@ -7,7 +7,7 @@ import os
 import re
 from urllib.parse import urljoin, urlparse, urlunparse, urldefrag
 
-from utils import utils, inspector, admin
+from utils import utils, inspector, admin, fetch
 
 # http://oig.hhs.gov/reports-and-publications/index.asp
 archive = 1985
@@ -36,6 +36,8 @@ archive = 1985
 #            B    - OIG Budget
 #            RAOR - Recovery Act Oversight Reports
 #            RAA  - Recovery Act-related Audit and Inspection Reports
+#
+#   skip_downloaded - skip the landing pages of reports that are already saved.
 
 # Notes for IG's web team:
 #  - A large number of reports don't list a date when they were published.
@@ -263,6 +265,9 @@ TITLE_NORMALIZATION = {
 
 BASE_URL = "http://oig.hhs.gov"
 
+# how many reports' landing pages are fetched (and kept parsed) at once
+CANDIDATES_PER_BATCH = 32
+
 
 def run(options):
   year_range = inspector.year_range(options, archive)
@@ -318,14 +323,14 @@ def extract_reports_for_subtopic(subtopic_url, year_range, topic_name, subtopic_
     results = doc.select("#leftContentInterior > p > a")
   if not results:
     raise inspector.NoReportsFoundError("HHS (%s)" % subtopic_name)
+  listed = []
   for result in results:
     if 'crossref' in result.parent.parent.attrs.get('class', []):
       continue
     if result.parent.parent.attrs.get('id') == 'related':
       continue
-    report = report_from(result, year_range, topic_name, subtopic_url, subtopic_name)
-    if report:
-      deduplicate_save_report(report)
+    listed.append((result, subtopic_name))
+  save_reports_from(listed, year_range, topic_name, subtopic_url)
 
 
 def extract_reports_for_oei(year_range):
@@ -403,13 +408,58 @@ def extract_reports_for_oei(year_range):
           all_results_links[url][1] = "%s, %s" % (all_results_links[url][1], subtopic_name)
 
   subtopic_url = TOPIC_TO_URL["OE"]
-  for result, subtopic_name in itertools.chain(all_results_links.values(), all_results_unreleased):
-    report = report_from(result, year_range, topic_name, subtopic_url, subtopic_name)
+  listed = itertools.chain(all_results_links.values(), all_results_unreleased)
+  save_reports_from(listed, year_range, topic_name, subtopic_url)
+
+
+# Turn (result, subtopic name) pairs from a listing page into reports, in
+# chunks of CANDIDATES_PER_BATCH. The landing pages and Last-Modified headers
+# a chunk needs are fetched concurrently up front, instead of one report at a
+# time, and each chunk is saved before the next is fetched, so only one
+# chunk's landing pages are held in memory at once.
+def save_reports_from(listed, year_range, topic, subtopic_url):
+  candidates = []
+  for result, subtopic_name in listed:
+    candidate = candidate_from(result, year_range, topic, subtopic_url, subtopic_name)
+    if candidate:
+      candidates.append(candidate)
+    if len(candidates) >= CANDIDATES_PER_BATCH:
+      save_candidates(candidates, year_range)
+      candidates = []
+  save_candidates(candidates, year_range)
+
+
+def save_candidates(candidates, year_range):
+  if not candidates:
+    return
+  landing_docs, last_modified = prefetch(candidates)
+
+  for candidate in candidates:
+    report = report_from(candidate, year_range, landing_docs, last_modified)
     if report:
       deduplicate_save_report(report)
 
 
-def report_from(result, year_range, topic, subtopic_url, subtopic=None):
+def prefetch(candidates):
+  landing_urls = []
+  head_urls = []
+  for candidate in candidates:
+    if candidate['report_id'] in REPORT_PUBLISHED_MAPPING:
+      continue
+    if candidate['extension'].lower() != '.pdf':
+      landing_urls.append(candidate['report_url'])
+    elif not published_on_from_listing(candidate['result'], candidate['title'],
+                                       candidate['report_id']):
+      head_urls.append(candidate['report_url'])
+
+  landing_docs = utils.beautifulsoups_from_urls(landing_urls)
+  last_modified = fetch.fetch_many(head_urls, last_modified_for)
+  return landing_docs, last_modified
+
+
+# The listing-page half of building a report: everything that can be worked
+# out without fetching anything else.
+def candidate_from(result, year_range, topic, subtopic_url, subtopic=None):
   # Ignore links to other subsections
   if result.get('class') and result['class'][0] == 'crossref':
     return
@@ -482,23 +532,52 @@ def report_from(result, year_range, topic, subtopic_url, subtopic=None):
           published_on.date == 12 and report_id == "20901002":
     return
 
+  # With --skip_downloaded, don't fetch landing pages or Last-Modified headers
+  # for reports that are already saved
+  if inspector.skip_known('hhs', report_id=report_id):
+    return
+
+  return {
+    'result': result,
+    'title': title,
+    'report_url': report_url,
+    'report_filename': report_filename,
+    'report_id': report_id,
+    'extension': extension,
+    'topic': topic,
+    'subtopic': subtopic,
+  }
+
+
+# The second half, using landing pages and Last-Modified headers that were
+# prefetched for the whole batch.
+def report_from(candidate, year_range, landing_docs, last_modified):
+  title = candidate['title']
+  report_url = candidate['report_url']
+  report_id = candidate['report_id']
+  topic = candidate['topic']
+  subtopic = candidate['subtopic']
+
   if report_id in REPORT_PUBLISHED_MAPPING:
     published_on = REPORT_PUBLISHED_MAPPING[report_id]
   else:
     # Process reports with landing pages
-    if extension.lower() != '.pdf':
-      report_url, published_on = report_from_landing_url(report_url)
+    if candidate['extension'].lower() != '.pdf':
+      report_url, published_on = report_from_landing_url(
+        report_url, landing_docs.get(report_url))
     else:
       published_on = published_on_from_inline_link(
-        result,
-        report_filename,
+        candidate['result'],
+        candidate['report_filename'],
         title,
         report_id,
         report_url,
+        last_modified,
       )
 
   if not published_on:
-    admin.log_no_date("hhs", report_id, title, report_url)
+    if last_modified.get(report_url) is not HEAD_FAILED:
+      admin.log_no_date("hhs", report_id, title, report_url)
     return
 
   if published_on.year not in year_range:
@@ -537,8 +616,9 @@ def filter_links(link_list, base_url):
   return filtered_list
 
 
-def report_from_landing_url(report_url):
-  doc = utils.beautifulsoup_from_url(report_url)
+def report_from_landing_url(report_url, doc=None):
+  if doc is None:
+    doc = utils.beautifulsoup_from_url(report_url)
   if not doc:
     raise Exception("Failure fetching report landing URL: %s" % report_url)
 
@@ -611,7 +691,23 @@ def get_published_date_from_tag(possible_tag):
       pass
 
 
-def published_on_from_inline_link(result, report_filename, title, report_id, report_url):
+def published_on_from_inline_link(result, report_filename, title, report_id,
+                                  report_url, last_modified=None):
+  published_on = published_on_from_listing(result, title, report_id)
+  if not published_on:
+    # Try using the last-modified header
+    if last_modified is None:
+      last_modified = {}
+    if report_url not in last_modified:
+      last_modified[report_url] = last_modified_for(report_url)
+    if last_modified[report_url] in (None, HEAD_FAILED):
+      return None
+    published_on = published_on_from_last_modified(last_modified[report_url],
+                                                   report_id)
+  return published_on
+
+
+def published_on_from_listing(result, title, report_id):
   published_on = None
   try:
     published_on_text = result.find_previous("dt").text.strip()
@@ -640,24 +736,38 @@ def published_on_from_inline_link(result, report_filename, title, report_id, rep
       published_on = datetime.datetime.strptime(report_id.split("-")[-1], "%m%d%Y")
     except ValueError:
       pass
-  if not published_on:
-    # Try using the last-modified header
+  return published_on
+
+
+# A HEAD request that fails is logged as an HTTP error here, and gives
+# HEAD_FAILED, so it isn't reported again as a report with no date. A
+# response without a Last-Modified header gives None.
+HEAD_FAILED = object()
+
+def last_modified_for(report_url):
+  try:
     response = utils.scraper.request(method='HEAD', url=report_url)
-    last_modified = response.headers['Last-Modified']
-    published_on = datetime.datetime.strptime(last_modified, '%a, %d %b %Y %H:%M:%S %Z')
-    if published_on.year < 2003:
-      # We don't trust the last-modified for dates before 2003
-      # since a lot of historical reports were published at this
-      # time. For these reports, fallback to a hacky method based
-      # on the report id. For example: oei-04-12-00490. These are
-      # the dates that the report_id was assigned which is before
-      # the report was actually published
-      published_on_text = "-".join(report_id.split("-")[1:3])
-      try:
-        published_on = datetime.datetime.strptime(published_on_text, '%m-%y')
-      except ValueError:
-        pass
-        # Fall back to the Last-Modified header
+  except utils.connection_errors() as e:
+    admin.log_http_error(e, report_url, "hhs")
+    return HEAD_FAILED
+  return response.headers.get('Last-Modified')
+
+
+def published_on_from_last_modified(last_modified, report_id):
+  published_on = datetime.datetime.strptime(last_modified, '%a, %d %b %Y %H:%M:%S %Z')
+  if published_on.year < 2003:
+    # We don't trust the last-modified for dates before 2003
+    # since a lot of historical reports were published at this
+    # time. For these reports, fallback to a hacky method based
+    # on the report id. For example: oei-04-12-00490. These are
+    # the dates that the report_id was assigned which is before
+    # the report was actually published
+    published_on_text = "-".join(report_id.split("-")[1:3])
+    try:
+      published_on = datetime.datetime.strptime(published_on_text, '%m-%y')
+    except ValueError:
+      pass
+      # Fall back to the Last-Modified header
   return published_on
 
 
@@ -13,6 +13,9 @@ archive = 1996
 # options:
 #   standard since/year options for a year range to fetch from.
 #
+#   skip_downloaded - skip the landing pages of reports that are already saved.
+#   stop_at_known - also stop paging once a whole page is already saved.
+#
 # Notes for IG's web team:
 #
 
@@ -45,47 +48,52 @@ def run(options):
   for year in year_range:
     report_type = 'audit'
     for page in range(0, ALL_PAGES):
-      reports_found = reports_from_page(AUDIT_REPORTS_URL, page, report_type, year_range, year)
-      if not reports_found:
+      listing = reports_from_page(AUDIT_REPORTS_URL, page, report_type, year_range, options, year)
+      if not listing:
         break
       else:
         results_flag = True
+      if listing.all_known():
+        break
   if not results_flag:
     raise inspector.NoReportsFoundError("Social Security Administration (audit)")
 
   # Pull the other reports
   for report_type, report_format in OTHER_REPORT_URLS.items():
     for page in range(0, ALL_PAGES):
-      reports_found = reports_from_page(report_format, page, report_type, year_range)
-      if not reports_found:
+      listing = reports_from_page(report_format, page, report_type, year_range, options)
+      if not listing:
         if page == 0:
           raise inspector.NoReportsFoundError("Social Security Administration (%s)" % report_type)
         else:
           break
+      if listing.all_known():
+        break
 
 
-def reports_from_page(url_format, page, report_type, year_range, year=''):
+def reports_from_page(url_format, page, report_type, year_range, options, year=''):
   url = url_format.format(page=page, year=year)
   doc = utils.beautifulsoup_from_url(url)
   results = doc.select("td.views-field")
   if not results:
     results = doc.select("div.views-row")
   if not results:
-    return False
+    return None
 
+  listing = inspector.ListingPage('ssa', options)
   for result in results:
     if not result.text.strip():
       # Skip empty rows
       continue
-    report = report_from(result, report_type, year_range)
+    report = report_from(result, report_type, year_range, listing)
     if report:
       inspector.save_report(report)
-  return True
+  return listing
 
 visited_landing_urls = set()
 
 
-def report_from(result, report_type, year_range):
+def report_from(result, report_type, year_range, listing):
   landing_page_link = result.find("a")
   title = landing_page_link.text.strip()
   landing_url = urljoin(BASE_REPORT_URL, landing_page_link['href'])
@@ -118,6 +126,9 @@ def report_from(result, report_type, year_range):
           "applications-0":
     report_id = "A-07-10-20166"
 
+  if listing.skip_known(report_id=report_id, landing_url=landing_url):
+    return
+
   landing_page = utils.beautifulsoup_from_url(landing_url)
 
   unreleased = False
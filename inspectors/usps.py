@@ -22,12 +22,9 @@ archive = 1997
 #             whitepapers - White Papers
 #             briefs - OIG Briefs
 #             other - Other
-
-# The report list is not stable, so sometimes we need to fetch the same page of
-# results multiple times to get everything. This constant is the maximum number
-# of times we will do so.
-MAX_RETRIES = 10
-REPORTS_PER_PAGE = 10
+#
+#   skip_downloaded - skip the landing pages of reports that are already saved.
+#   stop_at_known - also stop paging once a whole page is already saved.
 
 
 def run(options):
@@ -39,77 +36,41 @@ def run(options):
   for category_name, category_id in categories:
     pages = get_last_page(options, category_id)
 
-    rows_seen = set()
-    pages_to_fetch = range(1, pages + 1)
-
-    # While the reports themselves may shuffle around, the order of the dates
-    # of the reports and how many of each date we see on each page will stay
-    # constant. This dictionary will hold how many times we see each date.
-    # We can stop retrying pages once we have as many unique reports for each
-    # date as there are slots for that date.
-    date_slot_counts = {}
-
-    # This keeps track of how many unique reports we have found on each date,
-    # for comparison with the numbers above.
-    date_unique_report_counts = {}
-
-    # This dict maps from a report date to a list of pages on which that date
-    # was seen.
-    date_to_pages = {}
-
-    for retry in range(MAX_RETRIES):
-      for page in pages_to_fetch:
-        logging.debug("## Downloading %s, page %i, attempt %i" %
-                      (category_name, page, retry))
-        url = url_for(options, page, category_id)
-        doc = utils.beautifulsoup_from_url(url)
-
-        results = doc.select("tr")
-        if not results:
-          if ("Still can't find what you are searching for?" in
-                  doc.select(".content")[0].text):
-            # this search returned 0 results.
-            pass
-          else:
-            # Otherwise, there's probably something wrong with the scraper.
-            raise inspector.NoReportsFoundError("USPS %s" % category_name)
-        for result in results:
-          if not result.find("td"):
-            # Header row
-            continue
-          if retry == 0:
-            timestamp = get_timestamp(result)
-            if timestamp in date_slot_counts:
-              date_slot_counts[timestamp] = date_slot_counts[timestamp] + 1
-            else:
-              date_slot_counts[timestamp] = 1
-              date_unique_report_counts[timestamp] = 0
-
-            if timestamp in date_to_pages:
-              if page not in date_to_pages[timestamp]:
-                date_to_pages[timestamp].append(page)
-            else:
-              date_to_pages[timestamp] = [page]
-
-          row_key = (str(result.text), result.a['href'])
-          if row_key not in rows_seen:
-            rows_seen.add(row_key)
-            timestamp = get_timestamp(result)
-            date_unique_report_counts[timestamp] = \
-                date_unique_report_counts[timestamp] + 1
-
-            report = report_from(result)
-            inspector.save_report(report)
-
-      pages_to_fetch = set()
-      for date, report_count in date_unique_report_counts.items():
-        if report_count < date_slot_counts[date]:
-          for page in date_to_pages[date]:
-            pages_to_fetch.add(page)
-      if len(pages_to_fetch) == 0:
-        break
-      pages_to_fetch = list(pages_to_fetch)
-      pages_to_fetch.sort()
+    def fetch_page(page):
+      logging.debug("## Downloading %s, page %i" % (category_name, page))
+      url = url_for(options, page, category_id)
+      doc = utils.beautifulsoup_from_url(url)
+
+      results = doc.select("tr")
+      if not results:
+        if ("Still can't find what you are searching for?" in
+                doc.select(".content")[0].text):
+          # this search returned 0 results.
+          pass
+        else:
+          # Otherwise, there's probably something wrong with the scraper.
+          raise inspector.NoReportsFoundError("USPS %s" % category_name)
+      # skip header rows
+      return [result for result in results if result.find("td")]
+
+    # The report list is not stable, so rows that shift between pages are
+    # refetched until every date has as many reports as it has slots.
+    paginated = inspector.PaginatedListing("USPS %s" % category_name,
+                                           fetch_page, row_key, get_timestamp,
+                                           options=options)
+    for page, results in paginated.pages(range(1, pages + 1)):
+      listing = inspector.ListingPage('usps', options)
+      for result in results:
+        report = report_from(result, listing)
+        if report:
+          inspector.save_report(report)
+
+      # with --stop_at_known, don't go any deeper than the first page that
+      # only had reports we already have
+      if not paginated.refetching and listing.all_known():
+        logging.warn("[%s] Every report on page %i is known, stopping." %
+                     (category_name, page))
+        paginated.stop()
 
 
 def get_last_page(options, category_id):
@@ -123,8 +84,12 @@ def get_timestamp(result):
   return cells[0].text.strip()
 
 
+def row_key(result):
+  return (str(result.text), result.a['href'])
+
+
 # extract fields from HTML, return dict
-def report_from(result):
+def report_from(result, listing):
   report = {
     'inspector': 'usps',
     'inspector_url': 'https://uspsoig.gov/',
@@ -146,6 +111,9 @@ def report_from(result):
   landing_url = urljoin("https://uspsoig.gov/", link["href"])
   report['landing_url'] = landing_url
 
+  if listing.skip_known(landing_url=landing_url):
+    return
+
   landing_page = utils.beautifulsoup_from_url(landing_url)
   pdf_link = landing_page.find("a", text="View PDF")
   report_url = pdf_link["href"]
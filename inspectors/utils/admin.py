@@ -7,6 +7,7 @@ import yaml
 import logging
 import re
 import atexit
+import threading
 import requests
 import scrapelib
 
@@ -27,10 +28,12 @@ else:
   config = None
 
 
-def log_exception(e):
+# scraper can be given for exceptions raised outside of the scraper's own
+# code, e.g. on the save pipeline, where the traceback won't point to it
+def log_exception(e, scraper=None):
   for error_handler in error_handlers:
     try:
-      error_handler.log_exception(e)
+      error_handler.log_exception(e, scraper)
     except Exception as exception:
       print("Exception logging message to admin, halting as to avoid loop")
       print(format_exception(exception))
@@ -123,9 +126,16 @@ class ErrorHandler(object):
                  % (scraper, report_id, title, url.replace(" ", "%20")))
     self.log(message)
 
-  def log_exception(self, exception):
+  def log_exception(self, exception, scraper=None):
     self.log(format_exception(exception))
 
+  # state collected in a worker process, to be handed back to the parent
+  def export_state(self):
+    return None
+
+  def merge_state(self, state):
+    pass
+
 
 class ConsoleErrorHandler(ErrorHandler):
   def __init__(self):
@@ -139,6 +149,14 @@ class ConsoleErrorHandler(ErrorHandler):
     if self.uniqueness_messages:
       self.log("\n".join(self.uniqueness_messages))
 
+  def export_state(self):
+    messages = self.uniqueness_messages
+    self.uniqueness_messages = []
+    return messages
+
+  def merge_state(self, state):
+    self.uniqueness_messages.extend(state or [])
+
   def log(self, body):
     logging.error(body)
 
@@ -168,6 +186,14 @@ class EmailErrorHandler(ErrorHandler):
     if self.uniqueness_messages:
       self.log("\n".join(self.uniqueness_messages))
 
+  def export_state(self):
+    messages = self.uniqueness_messages
+    self.uniqueness_messages = []
+    return messages
+
+  def merge_state(self, state):
+    self.uniqueness_messages.extend(state or [])
+
   def log(self, body):
     settings = config['email']
     if (not settings.get('to') or not settings.get('from') or
@@ -241,6 +267,14 @@ class SlackErrorHandler(ErrorHandler):
         "text": "\n".join(self.uniqueness_messages)
       })
 
+  def export_state(self):
+    messages = self.uniqueness_messages
+    self.uniqueness_messages = []
+    return messages
+
+  def merge_state(self, state):
+    self.uniqueness_messages.extend(state or [])
+
   def send_message(self, message):
     copy_if_present("username", self.options, message)
     copy_if_present("icon_url", self.options, message)
@@ -288,9 +322,10 @@ class SlackErrorHandler(ErrorHandler):
       ]
     })
 
-  def log_exception(self, exception):
+  def log_exception(self, exception, scraper=None):
     class_name = exception_name(exception)
-    scraper, line_num, function = parse_scraper_traceback()
+    traceback_scraper, line_num, function = parse_scraper_traceback()
+    scraper = traceback_scraper or scraper
     fallback = "%s: %s" % (class_name, exception)
 
     pretext = ("%s was thrown while running %s.py (line %s, in function %s)" %
@@ -341,6 +376,9 @@ class DashboardErrorHandler(ErrorHandler):
   def __init__(self):
     self.options = config.get("dashboard")
     self.dashboard_data = {}
+    # reports are saved from several threads at once (see pipeline.py), and
+    # each of them can log here
+    self.lock = threading.Lock()
     atexit.register(self.dashboard_send)
 
   def log_http_error(self, exception, url, scraper):
@@ -348,95 +386,103 @@ class DashboardErrorHandler(ErrorHandler):
       return
     http_status_code = exception.response.status_code
 
-    if scraper not in self.dashboard_data:
-      self.dashboard_data[scraper] = {}
-    if "http_errors" not in self.dashboard_data[scraper]:
-      self.dashboard_data[scraper]["http_errors"] = []
-    entry = {
-      "status_code": http_status_code,
-      "url": url
-    }
-    self.dashboard_data[scraper]["http_errors"].append(entry)
+    with self.lock:
+      if scraper not in self.dashboard_data:
+        self.dashboard_data[scraper] = {}
+      if "http_errors" not in self.dashboard_data[scraper]:
+        self.dashboard_data[scraper]["http_errors"] = []
+      entry = {
+        "status_code": http_status_code,
+        "url": url
+      }
+      self.dashboard_data[scraper]["http_errors"].append(entry)
 
   def log_connection_error(self, exception, url, scraper):
     if scraper is None:
       return
 
-    if scraper not in self.dashboard_data:
-      self.dashboard_data[scraper] = {}
-    if "http_errors" not in self.dashboard_data[scraper]:
-      self.dashboard_data[scraper]["http_errors"] = []
-    class_name = exception_name(unwrap_exception(exception))
-    entry = {
-      "status_code": None,
-      "url": url,
-      "exception_name": class_name
-    }
-    self.dashboard_data[scraper]["http_errors"].append(entry)
+    with self.lock:
+      if scraper not in self.dashboard_data:
+        self.dashboard_data[scraper] = {}
+      if "http_errors" not in self.dashboard_data[scraper]:
+        self.dashboard_data[scraper]["http_errors"] = []
+      class_name = exception_name(unwrap_exception(exception))
+      entry = {
+        "status_code": None,
+        "url": url,
+        "exception_name": class_name
+      }
+      self.dashboard_data[scraper]["http_errors"].append(entry)
 
   def log_duplicate_id(self, scraper, report_id, msg):
-    if scraper not in self.dashboard_data:
-      self.dashboard_data[scraper] = {}
-    if "duplicate_ids" not in self.dashboard_data[scraper]:
-      self.dashboard_data[scraper]["duplicate_ids"] = []
-    self.dashboard_data[scraper]["duplicate_ids"].append(str(report_id))
-
-  def log_exception(self, exception):
+    with self.lock:
+      if scraper not in self.dashboard_data:
+        self.dashboard_data[scraper] = {}
+      if "duplicate_ids" not in self.dashboard_data[scraper]:
+        self.dashboard_data[scraper]["duplicate_ids"] = []
+      self.dashboard_data[scraper]["duplicate_ids"].append(str(report_id))
+
+  def log_exception(self, exception, scraper=None):
     class_name = exception_name(exception)
-    scraper, line_num, function = parse_scraper_traceback()
-
-    if scraper not in self.dashboard_data:
-      self.dashboard_data[scraper] = {}
-    if "exceptions" not in self.dashboard_data[scraper]:
-      self.dashboard_data[scraper]["exceptions"] = []
-    entry = {
-      "class_name": class_name,
-      "filename": "inspectors/%s.py" % scraper,
-      "line_num": line_num,
-      "function": function,
-      "traceback": format_exception(exception)
-    }
-    self.dashboard_data[scraper]["exceptions"].append(entry)
+    traceback_scraper, line_num, function = parse_scraper_traceback()
+    scraper = traceback_scraper or scraper
+
+    with self.lock:
+      if scraper not in self.dashboard_data:
+        self.dashboard_data[scraper] = {}
+      if "exceptions" not in self.dashboard_data[scraper]:
+        self.dashboard_data[scraper]["exceptions"] = []
+      entry = {
+        "class_name": class_name,
+        "filename": "inspectors/%s.py" % scraper,
+        "line_num": line_num,
+        "function": function,
+        "traceback": format_exception(exception)
+      }
+      self.dashboard_data[scraper]["exceptions"].append(entry)
 
   def log_no_date(self, scraper, report_id, title, url):
-    if scraper not in self.dashboard_data:
-      self.dashboard_data[scraper] = {}
-    if "missing_dates" not in self.dashboard_data[scraper]:
-      self.dashboard_data[scraper]["missing_dates"] = []
-    entry = {
-      "report_id": report_id,
-      "title": title,
-      "url": url
-    }
-    self.dashboard_data[scraper]["missing_dates"].append(entry)
+    with self.lock:
+      if scraper not in self.dashboard_data:
+        self.dashboard_data[scraper] = {}
+      if "missing_dates" not in self.dashboard_data[scraper]:
+        self.dashboard_data[scraper]["missing_dates"] = []
+      entry = {
+        "report_id": report_id,
+        "title": title,
+        "url": url
+      }
+      self.dashboard_data[scraper]["missing_dates"].append(entry)
 
   def log_qa(self, text):
     pass
 
   def dashboard_send(self):
-    if not self.dashboard_data:
-      return
-
-    for scraper in self.dashboard_data:
-      if "exceptions" in self.dashboard_data[scraper]:
-        severity = 2
-      elif "duplicate_ids" in self.dashboard_data[scraper]:
-        severity = 1
-      elif "missing_dates" in self.dashboard_data[scraper]:
-        severity = 1
-      elif "http_errors" in self.dashboard_data[scraper]:
-        severity = 1
-      else:
-        severity = 0
-      self.dashboard_data[scraper]["severity"] = severity
-
-      if "duplicate_ids" in self.dashboard_data[scraper]:
-        self.dashboard_data[scraper]["duplicate_ids"].sort()
-      if "report_count" not in self.dashboard_data[scraper]:
-        self.dashboard_data[scraper]["report_count"] = 0
+    with self.lock:
+      if not self.dashboard_data:
+        return
+
+      for scraper in self.dashboard_data:
+        if "exceptions" in self.dashboard_data[scraper]:
+          severity = 2
+        elif "duplicate_ids" in self.dashboard_data[scraper]:
+          severity = 1
+        elif "missing_dates" in self.dashboard_data[scraper]:
+          severity = 1
+        elif "http_errors" in self.dashboard_data[scraper]:
+          severity = 1
+        else:
+          severity = 0
+        self.dashboard_data[scraper]["severity"] = severity
+
+        if "duplicate_ids" in self.dashboard_data[scraper]:
+          self.dashboard_data[scraper]["duplicate_ids"].sort()
+        if "report_count" not in self.dashboard_data[scraper]:
+          self.dashboard_data[scraper]["report_count"] = 0
+
+      message_json = json.dumps(self.dashboard_data)
 
     options = config["dashboard"]
-    message_json = json.dumps(self.dashboard_data)
     message_bytes = message_json.encode("utf-8")
     url = options["url"] + "?secret=" + urllib.parse.quote(options["secret"])
     request = urllib.request.Request(url, message_bytes)
@@ -444,22 +490,64 @@ class DashboardErrorHandler(ErrorHandler):
     request.get_method = lambda: "PUT"
     urllib.request.urlopen(request)
 
+  def export_state(self):
+    with self.lock:
+      data = self.dashboard_data
+      self.dashboard_data = {}
+      return data
+
+  def merge_state(self, state):
+    with self.lock:
+      for scraper, data in (state or {}).items():
+        if scraper not in self.dashboard_data:
+          self.dashboard_data[scraper] = {}
+        for key, value in data.items():
+          if key == "report_count":
+            self.dashboard_data[scraper][key] = (value +
+                self.dashboard_data[scraper].get(key, 0))
+          else:
+            self.dashboard_data[scraper].setdefault(key, []).extend(value)
+
   def log_report(self, scraper):
-    if scraper not in self.dashboard_data:
-      self.dashboard_data[scraper] = {}
-    if "report_count" not in self.dashboard_data[scraper]:
-      self.dashboard_data[scraper]["report_count"] = 1
-    else:
-      self.dashboard_data[scraper]["report_count"] = (1 +
-          self.dashboard_data[scraper]["report_count"])
-
-
-error_handlers = [ConsoleErrorHandler()]
-if config:
-  if config.get("email"):
-    error_handlers.append(EmailErrorHandler())
-  if config.get("slack"):
-    error_handlers.append(SlackErrorHandler())
-  if config.get("dashboard"):
-    if config["dashboard"].get("secret"):
-      error_handlers.append(DashboardErrorHandler())
+    with self.lock:
+      if scraper not in self.dashboard_data:
+        self.dashboard_data[scraper] = {}
+      if "report_count" not in self.dashboard_data[scraper]:
+        self.dashboard_data[scraper]["report_count"] = 1
+      else:
+        self.dashboard_data[scraper]["report_count"] = (1 +
+            self.dashboard_data[scraper]["report_count"])
+
+
+def build_error_handlers():
+  handlers = [ConsoleErrorHandler()]
+  if config:
+    if config.get("email"):
+      handlers.append(EmailErrorHandler())
+    if config.get("slack"):
+      handlers.append(SlackErrorHandler())
+    if config.get("dashboard"):
+      if config["dashboard"].get("secret"):
+        handlers.append(DashboardErrorHandler())
+  return handlers
+
+
+# Used by ./igs --workers: each worker process gets its own set of handlers,
+# and hands their collected state back to the parent to be merged, so that
+# duplicate ID summaries and dashboard counts are only sent once.
+def reset_error_handlers():
+  global error_handlers
+  error_handlers = build_error_handlers()
+
+
+def export_state():
+  return [error_handler.export_state() for error_handler in error_handlers]
+
+
+def merge_state(states):
+  # handlers are built from the same config in every process, so line up
+  for error_handler, state in zip(error_handlers, states):
+    error_handler.merge_state(state)
+
+
+error_handlers = build_error_handlers()
@@ -0,0 +1,116 @@
+# content-addressed store for downloaded report files
+#
+# The same PDF is often saved under several report IDs, and sometimes under
+# several IGs. With the blob store turned on, each downloaded file is kept
+# once, by its SHA-256, and data/<ig>/<year>/<id>/report.<ext> becomes a
+# hardlink to it. Extracted text and metadata are keyed by the same hash (and
+# the extractor's version, see inspector.EXTRACTOR_VERSIONS), so an identical
+# file is only run through pdftotext/pdfinfo once.
+#
+# Turned on in admin.yml:
+#
+#   blob_store:
+#     directory: cache/blobs
+#
+# Entries live under the directory as:
+#
+#   <first two hex digits>/<sha256>        (the file itself)
+#   <first two hex digits>/<sha256>.<version>.txt  (extracted text)
+#   <first two hex digits>/<sha256>.json           (extracted metadata)
+#
+# Where hardlinks aren't possible (e.g. the store is on another filesystem),
+# files are copied instead. Report files never depend on the store existing,
+# so it can be deleted at any time.
+
+import errno
+import json
+import os
+import shutil
+import threading
+
+from . import admin
+from . import httpcache
+from . import utils
+
+
+class BlobStore(object):
+  def __init__(self, directory):
+    self.directory = directory
+
+  def path_for(self, content_hash, extension=None):
+    path = os.path.join(self.directory, content_hash[:2], content_hash)
+    if extension:
+      path = "%s.%s" % (path, extension)
+    return path
+
+  # put a freshly downloaded file into the store, or, if identical content is
+  # already there, swap the file for a link to the stored copy
+  def adopt(self, real_path, content_hash):
+    blob_path = self.path_for(content_hash)
+    if os.path.exists(blob_path):
+      if not os.path.samefile(blob_path, real_path):
+        link(blob_path, real_path)
+    else:
+      link(real_path, blob_path)
+
+  def has_text(self, content_hash, version):
+    return os.path.exists(self.path_for(content_hash, "%s.txt" % version))
+
+  def link_text(self, content_hash, version, real_text_path):
+    link(self.path_for(content_hash, "%s.txt" % version), real_text_path)
+
+  def put_text(self, content_hash, version, real_text_path):
+    if os.path.exists(real_text_path):
+      link(real_text_path, self.path_for(content_hash, "%s.txt" % version))
+
+  # a (found, metadata) pair, since None is a valid result for some file
+  # types. metadata from another version of the extractor isn't found.
+  def get_metadata(self, content_hash, version):
+    try:
+      with open(self.path_for(content_hash, "json"), 'r', encoding='utf-8') as f:
+        entry = json.load(f)
+    except (OSError, ValueError):
+      return False, None
+    if ('metadata' not in entry) or (entry.get('version') != version):
+      return False, None
+    return True, entry['metadata']
+
+  def put_metadata(self, content_hash, metadata, version):
+    entry = {'metadata': metadata, 'version': version}
+    httpcache.write_atomic(json.dumps(entry).encode('utf-8'),
+                           self.path_for(content_hash, "json"))
+
+
+# point destination at the same file as source, replacing whatever is there
+def link(source, destination):
+  os.makedirs(os.path.dirname(destination), exist_ok=True)
+  temp_path = "%s.%d.%d.tmp" % (destination, os.getpid(), threading.get_ident())
+  try:
+    os.link(source, temp_path)
+  except OSError as exc:
+    if exc.errno not in (errno.EXDEV, errno.EPERM, errno.EMLINK, errno.ENOTSUP):
+      raise
+    shutil.copyfile(source, temp_path)
+  os.replace(temp_path, destination)
+
+
+def store_directory():
+  config = admin.config and admin.config.get('blob_store')
+  if not config:
+    return None
+  if isinstance(config, dict) and config.get('directory'):
+    return config['directory']
+  return os.path.join(utils.cache_dir(), "blobs")
+
+
+_store = None
+
+# the configured store, or None when it's turned off
+def get_store():
+  global _store
+  directory = store_directory()
+  if directory is None:
+    return None
+  if _store is None or _store.directory != directory:
+    _store = BlobStore(directory)
+  return _store
@@ -0,0 +1,173 @@
+# one pass over the data directory, shared by every QA check
+#
+# Each script in scripts/ used to walk all of data/ on its own, and
+# duplicate_files read every byte of it besides. Instead, each one defines a
+# Check, and walk() makes a single traversal, spread across processes a
+# directory (usually an IG's year) at a time, reading each file at most once
+# and streaming its bytes through every check that wants it.
+#
+# A check's per-file work (start_file, update, end_file) runs in the worker
+# processes and returns a picklable result. Results come back to the parent
+# in a stable order (by IG, then walk order) and are handed to collect(),
+# which is where checks that compare files across IGs keep their state.
+
+import logging
+import os
+from concurrent.futures import ProcessPoolExecutor
+
+CHUNK_BYTES = 1024 * 1024
+
+
+class Check(object):
+  """Base class for QA checks. Subclasses set `name`, override wants() to
+  pick files, and override some of the hooks below. Findings are reported
+  with report(), and printed by whoever ran the check."""
+
+  name = None
+
+  # whether end_file needs the file's bytes passed through update() first,
+  # see reads() to decide file by file
+  reads_content = False
+
+  def __init__(self, options):
+    self.options = options
+    self.messages = []
+
+  def report(self, message):
+    self.messages.append(message)
+
+  # in the parent, before the walk
+  def begin(self):
+    pass
+
+  # in a worker: whether to look at this file at all
+  def wants(self, inspector, path):
+    return False
+
+  # in a worker: per-file state, passed to update() and end_file()
+  def start_file(self, inspector, path):
+    return None
+
+  # in a worker: whether this file's bytes need reading after all, e.g.
+  # false when start_file found a cached result
+  def reads(self, inspector, path, state):
+    return self.reads_content
+
+  # in a worker: one chunk of the file's bytes, in order
+  def update(self, state, chunk):
+    pass
+
+  # in a worker: the file's result, which must be picklable
+  def end_file(self, inspector, path, state):
+    return None
+
+  # in the parent, once per file end_file() returned a result for
+  def collect(self, inspector, path, result):
+    pass
+
+  # in the parent, after the walk
+  def finish(self):
+    pass
+
+
+# every IG with a directory under data_dir, limited to ig_list if given
+def inspectors_in(data_dir, ig_list=None):
+  if not os.path.isdir(data_dir):
+    return []
+  names = []
+  for name in sorted(os.listdir(data_dir)):
+    if ig_list and name not in ig_list:
+      continue
+    if os.path.isdir(os.path.join(data_dir, name)):
+      names.append(name)
+  return names
+
+
+# the pieces of work a walk is split into, in order: (inspector, directory,
+# whether to descend into it). each IG's subdirectories (its years) are
+# walked separately, so that one big IG doesn't hold up the whole pass.
+def units_for(data_dir, inspectors):
+  units = []
+  for inspector in inspectors:
+    inspector_path = os.path.join(data_dir, inspector)
+    units.append((inspector, inspector_path, False))
+    for name in sorted(os.listdir(inspector_path)):
+      path = os.path.join(inspector_path, name)
+      if os.path.isdir(path):
+        units.append((inspector, path, True))
+  return units
+
+
+# walk one directory and run every check on each of its files. returns a
+# list of (check index, path, result)
+def walk_unit(unit, checks):
+  inspector, top, recursive = unit
+  logging.debug("[%s] Checking %s..." % (inspector, top))
+  results = []
+  for dirpath, dirnames, filenames in os.walk(top):
+    if not recursive:
+      dirnames[:] = []
+    dirnames.sort()
+    for filename in sorted(filenames):
+      path = os.path.join(dirpath, filename)
+      wanted = [index for index, check in enumerate(checks)
+                if check.wants(inspector, path)]
+      if not wanted:
+        continue
+
+      states = {}
+      for index in wanted:
+        states[index] = checks[index].start_file(inspector, path)
+
+      readers = [index for index in wanted
+                 if checks[index].reads(inspector, path, states[index])]
+      if readers:
+        try:
+          with open(path, 'rb') as f:
+            for chunk in iter(lambda: f.read(CHUNK_BYTES), b''):
+              for index in readers:
+                checks[index].update(states[index], chunk)
+        except OSError as exc:
+          logging.warn("Couldn't read %s: %s" % (path, exc))
+          wanted = [index for index in wanted if index not in readers]
+
+      for index in wanted:
+        result = checks[index].end_file(inspector, path, states[index])
+        if result is not None:
+          results.append((index, path, result))
+  return results
+
+
+# run checks over every IG's files in one pass, with `workers` processes
+# (defaults to one per core). ig_list limits which IGs are walked.
+def walk(checks, data_dir, ig_list=None, workers=None):
+  for check in checks:
+    check.begin()
+
+  # checks that don't look at files (e.g. ones that read the manifest)
+  # don't need a walk at all
+  if any(type(check).wants is not Check.wants for check in checks):
+    units = units_for(data_dir, inspectors_in(data_dir, ig_list))
+  else:
+    units = []
+  workers = workers or os.cpu_count() or 1
+  if units:
+    with ProcessPoolExecutor(max_workers=min(workers, len(units))) as executor:
+      walked = executor.map(walk_unit, units, [checks] * len(units))
+      for unit, results in zip(units, walked):
+        for index, path, result in results:
+          checks[index].collect(unit[0], path, result)
+
+  for check in checks:
+    check.finish()
+  return checks
+
+
+# for running a single script's checks on their own, printing what they find
+def run_checks(checks, options, data_dir):
+  workers = options.get("workers")
+  workers = int(workers) if workers and workers is not True else None
+  walk(checks, data_dir, options.get("inspectors"), workers)
+  for check in checks:
+    for message in check.messages:
+      print(message)
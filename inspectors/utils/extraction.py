@@ -0,0 +1,94 @@
+# parallel (re)extraction of text and metadata for reports already on disk
+#
+# Fans extract_metadata/extract_report out across a pool of processes, one
+# report per task, so a backfill isn't bound to one pdftotext at a time. Only
+# extraction that's missing or was done by an older extractor is redone (see
+# inspector.EXTRACTOR_VERSIONS), so a backfill can be stopped and restarted.
+# Each worker process is capped by the memory limit under `extraction` in
+# admin.yml, and the external tools it runs are also subject to the per-file
+# timeout (see utils.tool_limits).
+
+import json
+import logging
+import os
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+try:
+  import resource
+except ImportError: # not available on Windows
+  resource = None
+
+from . import admin
+from . import blobs
+from . import inspector
+from . import utils
+
+
+def limit_memory():
+  _, memory_limit_mb = utils.tool_limits()
+  if memory_limit_mb and resource:
+    limit = int(memory_limit_mb) * 1024 * 1024
+    resource.setrlimit(resource.RLIMIT_AS, (limit, limit))
+
+
+# re-run extraction for one report, given the data-relative path to its
+# report.json, and write the JSON back with any new metadata and versions.
+#
+# Only the kinds of extraction that are stale are redone, unless forced.
+# `kinds` limits which kinds are considered at all, and `version` limits it to
+# reports whose recorded version of them is that one (0 for never recorded).
+#
+# returns (data_path, kinds redone, error message or None)
+def extract_file(data_path, force=False, kinds=None, version=None):
+  try:
+    real_data_path = os.path.join(utils.data_dir(), data_path)
+    with open(real_data_path, 'r', encoding='utf-8') as f:
+      report = json.load(f)
+
+    if report.get('unreleased') or not report.get('file_type'):
+      return data_path, [], None
+
+    report_path = inspector.path_for(report, report['file_type'])
+    real_report_path = os.path.join(utils.data_dir(), report_path)
+    if not os.path.exists(real_report_path):
+      return data_path, [], "Report file is missing: %s" % report_path
+
+    if force:
+      redo = [kind for kind in inspector.EXTRACTION_KINDS
+              if inspector.extractor_version(kind, report['file_type'])]
+    else:
+      redo = inspector.stale_extractions(report)
+    if kinds:
+      redo = [kind for kind in redo if kind in kinds]
+    if version is not None:
+      redo = [kind for kind in redo
+              if (inspector.extracted_version(report, kind) or 0) == version]
+    if not redo:
+      return data_path, [], None
+
+    content_hash = None
+    if blobs.get_store():
+      content_hash = utils.sha256_for(real_report_path)
+
+    if "metadata" in redo:
+      inspector.extract_metadata(report, content_hash, force=force)
+    if "text" in redo:
+      inspector.extract_report(report, content_hash, force=force)
+    inspector.write_report(report)
+    return data_path, redo, None
+  except Exception as exception:
+    return data_path, [], "%s: %s" % (admin.exception_name(exception), exception)
+
+
+# extract every report in data_paths across `workers` processes, yielding
+# results as they finish
+def extract_all(data_paths, workers=None, force=False, kinds=None, version=None):
+  workers = workers or os.cpu_count() or 1
+  with ProcessPoolExecutor(max_workers=workers, initializer=limit_memory) as executor:
+    futures = [executor.submit(extract_file, data_path, force, kinds, version)
+               for data_path in data_paths]
+    for future in as_completed(futures):
+      result = future.result()
+      if result[2]:
+        logging.warn("[%s] %s" % (result[0], result[2]))
+      yield result
@@ -0,0 +1,75 @@
+# concurrent fetching of many pages at once
+#
+# Scrapers that fan out to hundreds of landing pages spend nearly all of
+# their time waiting on round trips, one after another. This overlaps them:
+# each URL is fetched with utils.download on a thread, scheduled by asyncio,
+# so every request still goes through the shared scraper with its soft-404
+# adapters, cipher overrides, per-domain TLS verification, META_CHARSETS,
+# HTTP cache and per-host rate limits.
+#
+# The number of requests in flight is capped by `fetch_concurrency` in
+# admin.yml (default 8). Politeness toward each host is still governed by the
+# per-host rate limits, so raising the cap mostly helps scrapers that hit
+# several hosts, or hosts with generous limits.
+#
+# Synchronous callers use utils.fetch_many(urls); async code can iterate
+# over fetch_each(urls) as results come in.
+
+import asyncio
+import contextvars
+import logging
+from concurrent.futures import ThreadPoolExecutor
+
+from . import admin
+
+DEFAULT_CONCURRENCY = 8
+
+
+def concurrency():
+  if admin.config and admin.config.get('fetch_concurrency'):
+    return int(admin.config.get('fetch_concurrency'))
+  return DEFAULT_CONCURRENCY
+
+
+# run one fetch, logging any exception and giving back None instead, so that
+# one bad URL doesn't take the rest of the batch down with it
+def fetch_or_none(fetch, url):
+  try:
+    return fetch(url)
+  except Exception as exception:
+    logging.warn("## Error fetching %s: %s: %s" %
+                 (url, admin.exception_name(exception), exception))
+    return None
+
+
+# yields (url, body) pairs as each fetch finishes, body is None on failure.
+# `fetch` is a blocking function of one URL, e.g. a partial of utils.download
+async def fetch_each(urls, fetch, limit=None):
+  limit = limit or concurrency()
+  loop = asyncio.get_running_loop()
+
+  # the pool's size is what caps the number of requests in flight
+  with ThreadPoolExecutor(max_workers=limit) as executor:
+    async def fetch_one(url):
+      # carry the run context (see utils.run) over to the worker thread
+      context = contextvars.copy_context()
+      return url, await loop.run_in_executor(executor, context.run,
+                                             fetch_or_none, fetch, url)
+
+    for result in asyncio.as_completed([fetch_one(url) for url in urls]):
+      yield await result
+
+
+async def gather(urls, fetch, limit=None):
+  results = {}
+  async for url, body in fetch_each(urls, fetch, limit):
+    results[url] = body
+  return results
+
+
+# blocking wrapper around fetch_each, returns {url: body}
+def fetch_many(urls, fetch, limit=None):
+  urls = list(dict.fromkeys(urls))
+  if not urls:
+    return {}
+  return asyncio.run(gather(urls, fetch, limit))
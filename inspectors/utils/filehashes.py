@@ -0,0 +1,95 @@
+# persistent cache of the SHA-256s of files under the data directory
+#
+# Used by `./qa duplicate_files`, so that a nightly run only hashes the files
+# that are new or have changed since the last one. An entry is keyed by path,
+# and only trusted while the file's size, mtime and inode are all unchanged.
+#
+# Kept in cache/file_hashes.sqlite3, or wherever `file_hash_cache` in
+# admin.yml says. Deleting it just means everything gets hashed again.
+
+import os
+import sqlite3
+import threading
+
+from . import admin
+from . import utils
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS file_hashes (
+  path TEXT PRIMARY KEY,
+  size INTEGER NOT NULL,
+  mtime_ns INTEGER NOT NULL,
+  inode INTEGER NOT NULL,
+  sha256 TEXT NOT NULL
+);
+"""
+
+
+# what has to stay the same for a cached hash to still be good
+def stat_key(stat):
+  return (stat.st_size, stat.st_mtime_ns, stat.st_ino)
+
+
+class HashCache(object):
+  def __init__(self, path):
+    self.path = path
+    self.lock = threading.Lock()
+    self.connection = None
+    self.pid = None
+
+  # connections aren't carried over to the worker processes of a QA walk,
+  # each one opens its own
+  def __getstate__(self):
+    return {'path': self.path}
+
+  def __setstate__(self, state):
+    self.__init__(state['path'])
+
+  def connect(self):
+    if self.connection is None or self.pid != os.getpid():
+      if os.path.dirname(self.path):
+        utils.mkdir_p(os.path.dirname(self.path))
+      self.connection = sqlite3.connect(self.path, timeout=60,
+                                        check_same_thread=False)
+      self.connection.execute("PRAGMA journal_mode=WAL")
+      self.connection.executescript(SCHEMA)
+      self.pid = os.getpid()
+    return self.connection
+
+  # the cached hex digest for a path, if its stat key still matches
+  def lookup(self, path, key):
+    with self.lock:
+      rows = self.connect().execute(
+        "SELECT size, mtime_ns, inode, sha256 FROM file_hashes WHERE path = ?",
+        (path,)).fetchall()
+    if rows and tuple(rows[0][:3]) == tuple(key):
+      return rows[0][3]
+    return None
+
+  # entries are (path, (size, mtime_ns, inode), sha256)
+  def store(self, entries):
+    with self.lock:
+      connection = self.connect()
+      with connection:
+        connection.executemany(
+          "INSERT OR REPLACE INTO file_hashes VALUES (?, ?, ?, ?, ?)",
+          [(path,) + tuple(key) + (sha256,) for path, key, sha256 in entries])
+
+  # forget files under a directory that weren't seen, i.e. have been deleted
+  def prune(self, directory, seen):
+    prefix = os.path.join(directory, "")
+    with self.lock:
+      connection = self.connect()
+      with connection:
+        paths = [row[0] for row in connection.execute(
+          "SELECT path FROM file_hashes WHERE substr(path, 1, ?) = ?",
+          (len(prefix), prefix))]
+        connection.executemany("DELETE FROM file_hashes WHERE path = ?",
+                               [(path,) for path in paths if path not in seen])
+
+
+# assumes working dir is the root dir, like utils.data_dir()
+def cache_path():
+  if admin.config and admin.config.get('file_hash_cache'):
+    return admin.config.get('file_hash_cache')
+  return os.path.join(utils.cache_dir(), "file_hashes.sqlite3")
@@ -0,0 +1,148 @@
+# record/replay of HTTP traffic, for running scrapers offline
+#
+#   --record: fetch from the web as usual, and save every response
+#   --replay: serve every request from saved responses, never touching the web
+#
+# Both take an optional directory (--record=fixtures/2017-06), defaulting to
+# `fixtures_directory` in admin.yml, or cache/fixtures. Note that options are
+# lowercased, so the directory name should be too.
+#
+# Responses are saved one per request, including each hop of a redirect, as:
+#
+#   <first two hex digits>/<key>.json   (url, method, status, headers)
+#   <first two hex digits>/<key>.body   (raw response body)
+#
+# where the key is a SHA-256 of the method, URL and request body. Requests
+# are captured below scrapelib and above the transport, so replayed responses
+# keep the status codes the soft-404 adapters assigned when recording.
+
+import hashlib
+import json
+import logging
+import os
+
+import requests
+
+from . import admin
+from . import httpcache
+from . import utils
+
+
+class FixtureArchive(object):
+  def __init__(self, directory):
+    self.directory = directory
+
+  def key_for(self, request):
+    body = request.body or b""
+    if isinstance(body, str):
+      body = body.encode("utf-8")
+    key = hashlib.sha256(("%s %s\n" % (request.method, request.url)).encode("utf-8"))
+    key.update(body)
+    return key.hexdigest()
+
+  def paths_for(self, request):
+    key = self.key_for(request)
+    base = os.path.join(self.directory, key[:2], key)
+    return base + ".json", base + ".body"
+
+  def save(self, request, response):
+    # the body is saved already decoded
+    headers = dict(response.headers)
+    headers.pop('Content-Encoding', None)
+    headers.pop('Transfer-Encoding', None)
+    entry = {
+      'method': request.method,
+      'url': request.url,
+      'status': response.status_code,
+      'reason': response.reason,
+      'headers': headers,
+    }
+    meta_path, body_path = self.paths_for(request)
+    httpcache.write_atomic(response.content, body_path)
+    httpcache.write_atomic(json.dumps(entry).encode('utf-8'), meta_path)
+
+  def load(self, request):
+    meta_path, body_path = self.paths_for(request)
+    if not os.path.exists(meta_path):
+      return None
+    with open(meta_path, 'r', encoding='utf-8') as f:
+      entry = json.load(f)
+    with open(body_path, 'rb') as f:
+      entry['body'] = f.read()
+    return entry
+
+
+class RecordingAdapter(requests.adapters.BaseAdapter):
+  """Wraps the adapter that would have handled a request, and saves its
+  responses to the archive."""
+
+  def __init__(self, archive, adapter):
+    super(RecordingAdapter, self).__init__()
+    self.archive = archive
+    self.adapter = adapter
+
+  def send(self, request, **kwargs):
+    response = self.adapter.send(request, **kwargs)
+    try:
+      self.archive.save(request, response)
+    except OSError as exc:
+      logging.warn("Couldn't record %s: %s" % (request.url, exc))
+    return response
+
+  def close(self):
+    self.adapter.close()
+
+
+class ReplayAdapter(requests.adapters.BaseAdapter):
+  """Serves responses from the archive. Unrecorded requests fail like a
+  connection error would."""
+
+  def __init__(self, archive):
+    super(ReplayAdapter, self).__init__()
+    self.archive = archive
+
+  def send(self, request, **kwargs):
+    entry = self.archive.load(request)
+    if entry is None:
+      raise requests.exceptions.ConnectionError(
+        "No recorded response for %s %s" % (request.method, request.url),
+        request=request)
+
+    response = requests.models.Response()
+    response.status_code = entry['status']
+    response.reason = entry.get('reason')
+    response.headers = requests.structures.CaseInsensitiveDict(entry['headers'])
+    response.encoding = requests.utils.get_encoding_from_headers(response.headers)
+    response._content = entry['body']
+    response._content_consumed = True
+    response.url = request.url
+    response.request = request
+    response.connection = self
+    return response
+
+  def close(self):
+    pass
+
+
+# switch the scraper into record or replay mode, per the options. returns
+# the archive in use, or None.
+def configure(scraper, options):
+  if options.get('replay'):
+    mode, directory = "replay", options['replay']
+  elif options.get('record'):
+    mode, directory = "record", options['record']
+  else:
+    return None
+
+  if directory is True:
+    directory = default_directory()
+  archive = FixtureArchive(directory)
+  scraper.use_fixtures(archive, mode)
+  logging.info("## %s HTTP fixtures: %s" % (mode.capitalize(), directory))
+  return archive
+
+
+def default_directory():
+  if admin.config and admin.config.get('fixtures_directory'):
+    return admin.config.get('fixtures_directory')
+  return os.path.join(utils.cache_dir(), "fixtures")
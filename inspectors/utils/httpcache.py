@@ -0,0 +1,169 @@
+# on-disk HTTP cache for conditional GETs
+#
+# Stores the body of every text page that came with an ETag or Last-Modified
+# validator, and sends If-None-Match / If-Modified-Since the next time the
+# page is requested. A 304 response is then filled in from disk.
+#
+# Entries live under the cache directory as:
+#
+#   http/<first two hex digits>/<sha256 of url>.json   (validators, encoding)
+#   http/<first two hex digits>/<sha256 of url>.body   (raw response body)
+#
+# URLs with a cache-busting parameter (e.g. usps's &t=<timestamp>) are never
+# the same twice, so they're left out. Entries that haven't been used for
+# max_age_days (30 by default) are pruned, at most once a day:
+#
+#   http_cache:
+#     max_age_days: 30
+
+import hashlib
+import json
+import logging
+import os
+import threading
+import time
+import urllib.parse
+
+DEFAULT_MAX_AGE_DAYS = 30
+PRUNE_INTERVAL_SECONDS = 24 * 60 * 60
+
+# query parameters scrapers add with a timestamp, to get around caching
+CACHE_BUSTER_PARAMS = ("t", "_", "timestamp", "cachebuster")
+
+
+# whether a URL carries a cache-busting parameter with a numeric value
+def volatile(url):
+  query = urllib.parse.urlparse(url).query
+  for name, value in urllib.parse.parse_qsl(query, keep_blank_values=True):
+    if name.lower() in CACHE_BUSTER_PARAMS and value.isdigit():
+      return True
+  return False
+
+
+# the URL without any cache-busting parameters, for keying caches on
+def without_cache_busters(url):
+  parsed = urllib.parse.urlparse(url)
+  if not parsed.query:
+    return url
+  query = [(name, value) for name, value in
+           urllib.parse.parse_qsl(parsed.query, keep_blank_values=True)
+           if not (name.lower() in CACHE_BUSTER_PARAMS and value.isdigit())]
+  return urllib.parse.urlunparse(
+    parsed._replace(query=urllib.parse.urlencode(query)))
+
+
+class HttpCache(object):
+  def __init__(self, directory, max_age_days=DEFAULT_MAX_AGE_DAYS):
+    self.directory = directory
+    self.max_age = max_age_days * 24 * 60 * 60
+
+  def paths_for(self, url):
+    key = hashlib.sha256(url.encode("utf-8")).hexdigest()
+    base = os.path.join(self.directory, key[:2], key)
+    return base + ".json", base + ".body"
+
+  def get(self, url):
+    if volatile(url):
+      return None
+    meta_path, body_path = self.paths_for(url)
+    if not (os.path.exists(meta_path) and os.path.exists(body_path)):
+      return None
+    try:
+      with open(meta_path, 'r', encoding='utf-8') as f:
+        entry = json.load(f)
+    except ValueError:
+      return None
+    # an entry's age, for pruning, counts from when it was last used
+    try:
+      os.utime(meta_path)
+    except OSError:
+      pass
+    return entry
+
+  def conditional_headers(self, entry):
+    headers = {}
+    if entry.get('etag'):
+      headers['If-None-Match'] = entry['etag']
+    if entry.get('last_modified'):
+      headers['If-Modified-Since'] = entry['last_modified']
+    return headers
+
+  # fill in a 304 response with the cached body, so callers can treat it
+  # like the original 200
+  def restore(self, entry, response):
+    _, body_path = self.paths_for(entry['url'])
+    with open(body_path, 'rb') as f:
+      response._content = f.read()
+    response.status_code = 200
+    response.encoding = entry.get('encoding')
+    response.from_http_cache = True
+    return response
+
+  def store(self, url, response):
+    etag = response.headers.get('ETag')
+    last_modified = response.headers.get('Last-Modified')
+    if response.status_code != 200 or not (etag or last_modified):
+      return
+    if volatile(url):
+      return
+
+    entry = {
+      'url': url,
+      'etag': etag,
+      'last_modified': last_modified,
+      'encoding': response.encoding,
+    }
+    meta_path, body_path = self.paths_for(url)
+    try:
+      write_atomic(response.content, body_path)
+      write_atomic(json.dumps(entry).encode('utf-8'), meta_path)
+    except OSError as exc:
+      logging.warn("Couldn't write HTTP cache entry for %s: %s" % (url, exc))
+
+
+  # delete entries that haven't been used in max_age seconds. runs at most
+  # once per PRUNE_INTERVAL_SECONDS, tracked by a marker file.
+  def prune(self):
+    marker_path = os.path.join(self.directory, ".last_pruned")
+    now = time.time()
+    try:
+      if now - os.path.getmtime(marker_path) < PRUNE_INTERVAL_SECONDS:
+        return 0
+    except OSError:
+      pass
+    if not os.path.isdir(self.directory):
+      return 0
+    write_atomic(b"", marker_path)
+
+    pruned = 0
+    cutoff = now - self.max_age
+    for prefix in os.listdir(self.directory):
+      prefix_path = os.path.join(self.directory, prefix)
+      if not os.path.isdir(prefix_path):
+        continue
+      for name in os.listdir(prefix_path):
+        if not name.endswith(".json"):
+          continue
+        meta_path = os.path.join(prefix_path, name)
+        try:
+          if os.path.getmtime(meta_path) >= cutoff:
+            continue
+          os.remove(meta_path)
+          body_path = meta_path[:-len(".json")] + ".body"
+          if os.path.exists(body_path):
+            os.remove(body_path)
+          pruned += 1
+        except OSError:
+          pass
+    logging.info("## Pruned %i stale HTTP cache entries" % pruned)
+    return pruned
+
+
+# write to a temp file and rename, so that concurrent readers never see a
+# half-written entry
+def write_atomic(content, destination):
+  os.makedirs(os.path.dirname(destination), exist_ok=True)
+  temp_path = "%s.%d.%d.tmp" % (destination, os.getpid(), threading.get_ident())
+  with open(temp_path, 'wb') as f:
+    f.write(content)
+  os.replace(temp_path, destination)
@@ -3,24 +3,31 @@ import os
 import re
 import logging
 import datetime
+import json
 import urllib.parse
-import inspect
 
 from . import admin
+from . import blobs
+from . import fetch
+from . import manifest
+from . import pipeline
+from . import stats
 # Save a report to disk, provide output along the way.
 #
 # 1) download report to disk
 # 2) extract text from downloaded report using report['file_type']
 # 3) write report metadata to disk
 #
+# Steps 1-3 run in the background on the save pipeline (see pipeline.py),
+# unless --save_workers=0 is given, so that the scraper can keep going.
+#
 # fields used: file_type, url, inspector, year, report_id
 # fields added: report_path, text_path
 
 def save_report(report):
-  caller_filename = inspect.stack()[1][1]
-  caller_scraper = os.path.splitext(os.path.basename(caller_filename))[0]
+  caller_scraper = utils.calling_scraper()
 
-  options = utils.options()
+  options = utils.run_context().options
 
   # create some inferred fields, set defaults
   preprocess_report(report)
@@ -37,33 +44,74 @@ def save_report(report):
 
   logging.warn("[%s][%s][%s]" % (report['type'], report['published_on'], report['report_id']))
 
-  if options.get('dry_run'):
-    logging.warn('\tdry run: skipping download and extraction')
-    if (not options.get('quick')) and report.get('url'):
-      utils.check_report_url(report['url'])
-  elif report.get('unreleased', False) is True:
-    logging.warn('\tno download/extraction of unreleased report')
-  else:
-    report_path = download_report(report, caller_scraper=caller_scraper)
-    if not report_path:
-      logging.warn("\terror downloading report: sadly, skipping.")
-      return False
-
-    logging.warn("\treport: %s" % report_path)
-
-    metadata = extract_metadata(report)
-    if metadata:
-      for key, value in metadata.items():
-        logging.debug("\t%s: %s" % (key, value))
-
-    text_path = extract_report(report)
-    logging.warn("\ttext: %s" % text_path)
-
-  data_path = write_report(report)
-  logging.warn("\tdata: %s" % data_path)
-
-  admin.log_report(caller_scraper)
-  return True
+  if incremental(options) and is_known(report['inspector'], report['report_id']):
+    logging.warn('\tpreviously saved: skipping download and extraction')
+    admin.log_report(caller_scraper)
+    return True
+
+  save_pipeline = pipeline.get_pipeline(options)
+  if save_pipeline:
+    save_pipeline.submit(caller_scraper, finish_report, report, options,
+                         caller_scraper)
+    return True
+  return finish_report(report, options, caller_scraper)
+
+
+# the download/extraction half of save_report, run once a report is valid
+def finish_report(report, options, caller_scraper):
+  stats.count("reports")
+  with stats.timer("save_report_seconds"):
+    status = None
+    content_hash = None
+    stat = None
+
+    if options.get('dry_run'):
+      logging.warn('\tdry run: skipping download and extraction')
+      if (not options.get('quick')) and report.get('url'):
+        utils.check_report_url(report['url'])
+    elif report.get('unreleased', False) is True:
+      logging.warn('\tno download/extraction of unreleased report')
+      status = manifest.STATUS_UNRELEASED
+    else:
+      report_path = download_report(report, caller_scraper=caller_scraper)
+      if not report_path:
+        logging.warn("\t[%s] error downloading report: sadly, skipping." % report['report_id'])
+        manifest.get_manifest().record(report, manifest.STATUS_FAILED)
+        return False
+
+      logging.warn("\treport: %s" % report_path)
+      status = manifest.STATUS_DOWNLOADED
+      real_report_path = os.path.join(utils.data_dir(), report_path)
+      # files already on disk from an earlier run needn't be hashed again
+      content_hash = manifest.get_manifest().hash_for(report, os.stat(real_report_path))
+      if not content_hash:
+        content_hash = utils.sha256_for(real_report_path)
+      store = blobs.get_store()
+      if store:
+        store.adopt(real_report_path, content_hash)
+      # after adopt, since that may have swapped in the stored copy
+      stat = os.stat(real_report_path)
+      report['file_size'] = stat.st_size
+      report['file_sha256'] = content_hash
+
+      extractors = previous_extractors(report, content_hash)
+      if extractors:
+        report['extractors'] = extractors
+
+      metadata = extract_metadata(report, content_hash)
+      if metadata:
+        for key, value in metadata.items():
+          logging.debug("\t%s: %s" % (key, value))
+
+      text_path = extract_report(report, content_hash)
+      logging.warn("\ttext: %s" % text_path)
+
+    data_path = write_report(report)
+    logging.warn("\tdata: %s" % data_path)
+    manifest.get_manifest().record(report, status, content_hash, stat)
+
+    admin.log_report(caller_scraper)
+    return True
 
 
 # Preprocess before validation, to catch cases where inference didn't work.
@@ -215,36 +263,28 @@ class ReportIdCache:
     self.disk = {}
     self.runtime = {}
 
-  def scan_disk(self, inspector, scraper):
+  # load report IDs already saved for this inspector from the manifest
+  def load_saved(self, inspector, scraper):
     self.disk[inspector] = {}
-    data_dir = utils.data_dir()
-    inspector_path = os.path.join(data_dir, inspector)
-    if os.path.isdir(inspector_path):
-      for year_folder in os.listdir(inspector_path):
-        year_disk = int(year_folder)
-        year_path = os.path.join(inspector_path, year_folder)
-        if os.path.isdir(year_path):
-          for report_id_disk in os.listdir(year_path):
-            report_path = os.path.join(year_path, report_id_disk)
-            report_id_disk = CaseInsensitiveString(report_id_disk)
-            if os.path.isdir(report_path):
-              if report_id_disk in self.disk[inspector]:
-                year_last = self.disk[inspector][report_id_disk]
-                msg = "[%s] Duplicate report_id: %s is saved under %d and %d" %\
-                        (inspector,
-                        report_id_disk,
-                        year_last,
-                        year_disk)
-                print(msg)
-                admin.log_duplicate_id(inspector, report_id_disk, msg)
-              self.disk[inspector][report_id_disk] = year_disk
+    for report_id_disk, year_disk in manifest.get_manifest().years_for(inspector):
+      report_id_disk = CaseInsensitiveString(report_id_disk)
+      if report_id_disk in self.disk[inspector]:
+        year_last = self.disk[inspector][report_id_disk]
+        msg = "[%s] Duplicate report_id: %s is saved under %d and %d" %\
+                (inspector,
+                report_id_disk,
+                year_last,
+                year_disk)
+        print(msg)
+        admin.log_duplicate_id(inspector, report_id_disk, msg)
+      self.disk[inspector][report_id_disk] = year_disk
 
   def add(self, inspector, report_id, report_year, scraper):
     report_id = CaseInsensitiveString(report_id)
     if inspector not in self.runtime:
       self.runtime[inspector] = set()
     if inspector not in self.disk:
-      self.scan_disk(inspector, scraper)
+      self.load_saved(inspector, scraper)
     if report_id in self.runtime[inspector]:
       msg = ("[%s] Duplicate report_id: %s has been used twice this session" %
              (scraper, report_id))
@@ -267,13 +307,172 @@ def check_uniqueness(inspector, report_id, report_year, scraper):
   report, this function will check whether a duplicate report_id exists on-disk
   under a different year, or whether a duplicate report_id has been saved this
   session, in the same year or any other year. The index of reports already
-  saved is lazily built on the first call from each inspector. Duplicate
+  saved is lazily loaded from the manifest on the first call from each
+  inspector. Duplicate
   reports detected here will be collected, and a summary will be logged.'''
 
   cache = ReportIdCache.get_cache()
   cache.add(inspector, report_id, report_year, scraper)
 
 
+# Incremental mode: with --skip_downloaded, scrapers can ask whether a report
+# has already been saved, and skip fetching its landing page and downloading
+# it again. With --stop_at_known, a scraper can also stop paging through a
+# listing once a whole page turns up nothing but reports we already have.
+def incremental(options=None):
+  if options is None:
+    options = utils.run_context().options
+  return bool(options.get('skip_downloaded') or options.get('stop_at_known'))
+
+def is_known(inspector, report_id=None, landing_url=None):
+  return manifest.get_manifest().is_known(inspector, report_id, landing_url)
+
+def skip_known(inspector, report_id=None, landing_url=None, options=None):
+  if not incremental(options):
+    return False
+  if is_known(inspector, report_id, landing_url):
+    logging.warn("[%s] Skipping previously saved report, as asked." %
+                 (report_id or landing_url))
+    return True
+  return False
+
+
+class ListingPage:
+  """Tracks how many reports on one page of a listing were already known."""
+
+  def __init__(self, inspector, options=None):
+    self.inspector = inspector
+    self.options = options
+    self.seen = 0
+    self.known = 0
+
+  def skip_known(self, report_id=None, landing_url=None):
+    self.seen += 1
+    if skip_known(self.inspector, report_id, landing_url, self.options):
+      self.known += 1
+      return True
+    return False
+
+  def all_known(self):
+    options = utils.run_context().options if self.options is None else self.options
+    return bool(options.get('stop_at_known')) and \
+      self.seen > 0 and self.known == self.seen
+
+
+# How many times a paginated listing will refetch pages whose rows shifted.
+MAX_PAGE_RETRIES = 10
+
+class PaginatedListing:
+  """Pages through a listing whose row order isn't stable between requests.
+
+  Sites like USPS and SBA sort their listings by date, but shuffle rows with
+  the same date from one request to the next, so a single pass over the pages
+  can miss some rows and see others twice. The number of rows for each date
+  on each page stays put, though. So after a first pass (fetched concurrently,
+  a few pages at a time) we know how many rows each date should have, and
+  only the pages holding dates that came up short are fetched again.
+
+  fetch_page(page) returns the rows of one page, row_key(row) identifies a
+  row, and row_group(row) gives the sort key rows are shuffled within (e.g.
+  the date). pages() yields (page, new rows) for each page fetched.
+
+  With --stop_at_known, a scraper may stop() the first pass early, so it
+  starts out one page at a time and only fetches more at once (doubling up
+  to the usual concurrency) as pages keep turning up something new.
+  """
+
+  def __init__(self, name, fetch_page, row_key, row_group,
+               max_retries=MAX_PAGE_RETRIES, options=None):
+    self.name = name
+    self.fetch_page = fetch_page
+    self.row_key = row_key
+    self.row_group = row_group
+    self.max_retries = max_retries
+    self.options = options
+
+    self.seen = set()
+    self.slot_counts = {}  # group => rows with that group on the first pass
+    self.unique_counts = {}  # group => distinct rows seen with that group
+    self.group_pages = {}  # group => pages the group was seen on
+    self.refetches = 0
+    self.refetching = False
+    self.stopped = False
+
+  # stop the first pass after the current page, e.g. with --stop_at_known
+  def stop(self):
+    self.stopped = True
+
+  # the first pass has to see every page to know what to reconcile, so a
+  # page that fails there fails the whole listing, with its own exception
+  def fetch_first(self, page):
+    try:
+      return self.fetch_page(page), None
+    except Exception as exception:
+      return None, exception
+
+  def pages(self, page_numbers):
+    page_numbers = list(page_numbers)
+    options = utils.run_context().options if self.options is None else self.options
+    if options.get('stop_at_known'):
+      window = 1
+    else:
+      window = fetch.concurrency()
+    start = 0
+    while start < len(page_numbers) and not self.stopped:
+      pages = page_numbers[start:start + window]
+      start += len(pages)
+      fetched = fetch.fetch_many(pages, self.fetch_first)
+      for page in pages:
+        rows, exception = fetched[page]
+        if exception is not None:
+          raise exception
+        yield page, self.new_rows(page, rows, count_slots=True)
+        if self.stopped:
+          break
+      window = min(window * 2, fetch.concurrency())
+
+    self.refetching = True
+    for retry in range(1, self.max_retries):
+      pages = self.unreconciled_pages()
+      if not pages:
+        break
+      logging.debug("## %s: refetching pages %s, attempt %i" %
+                    (self.name, pages, retry))
+      self.refetches += len(pages)
+      # the point is to see the pages as they are now, not as they were
+      with utils.fresh():
+        fetched = fetch.fetch_many(pages, self.fetch_page)
+      for page in pages:
+        # a page that failed this time is tried again on the next attempt
+        yield page, self.new_rows(page, fetched[page] or [])
+
+    stats.count("listing_refetches", self.refetches)
+    logging.info("## %s: %i pages refetched" % (self.name, self.refetches))
+
+  def new_rows(self, page, rows, count_slots=False):
+    new = []
+    for row in rows:
+      group = self.row_group(row)
+      if count_slots:
+        self.slot_counts[group] = self.slot_counts.get(group, 0) + 1
+        self.group_pages.setdefault(group, set()).add(page)
+
+      key = self.row_key(row)
+      if key not in self.seen:
+        self.seen.add(key)
+        self.unique_counts[group] = self.unique_counts.get(group, 0) + 1
+        new.append(row)
+    return new
+
+  # pages holding groups that have fewer distinct rows than slots
+  def unreconciled_pages(self):
+    pages = set()
+    for group, slot_count in self.slot_counts.items():
+      if self.unique_counts.get(group, 0) < slot_count:
+        pages.update(self.group_pages[group])
+    return sorted(pages)
+
+
 # run over common string fields automatically
 sanitize_table = str.maketrans({
   "\xa0": " ",          # no-break space
@@ -314,23 +513,106 @@ def download_report(report, caller_scraper=None):
   else:
     return None
 
-FILE_EXTENSIONS_HTML = ("htm", "html", "shtml", "cfm", "php", "asp", "aspx")
+FILE_EXTENSIONS_HTML = utils.FILE_EXTENSIONS_HTML
+
+# Versions of the text and metadata extractors for each kind of file. Bump
+# one whenever its extractor changes, and ./extract will redo the reports
+# that were extracted with an older version. Each report.json records the
+# versions it was extracted with, as e.g. "extractors": {"text": 1}.
+EXTRACTOR_VERSIONS = {
+  "metadata": {"pdf": 2, "doc": 1, "docx": 1},
+  "text": {"pdf": 1, "doc": 1, "docx": 1, "html": 1},
+}
+EXTRACTION_KINDS = ("metadata", "text")
+
+# the current version of one kind of extractor for a file type, or None if
+# there's no such extractor
+def extractor_version(kind, file_type):
+  file_type = file_type.lower()
+  if file_type in FILE_EXTENSIONS_HTML:
+    file_type = "html"
+  return EXTRACTOR_VERSIONS[kind].get(file_type)
+
+# the version a report was last extracted with, or None
+def extracted_version(report, kind):
+  return (report.get('extractors') or {}).get(kind)
+
+def record_extraction(report, kind):
+  report.setdefault('extractors', {})[kind] = \
+    extractor_version(kind, report['file_type'])
+
+# the kinds of extraction a report is missing, or has from an older extractor
+def stale_extractions(report):
+  stale = []
+  for kind in EXTRACTION_KINDS:
+    version = extractor_version(kind, report['file_type'])
+    if version is None:
+      continue
+    if extracted_version(report, kind) != version:
+      stale.append(kind)
+    elif kind == "text" and not os.path.exists(
+        os.path.join(utils.data_dir(), text_path_for(report))):
+      stale.append(kind)
+  return stale
+
+# what an earlier save of this same file was extracted with, so that
+# re-running a scraper doesn't redo extraction that's still current
+def previous_extractors(report, content_hash):
+  try:
+    with open(os.path.join(utils.data_dir(), path_for(report, "json")),
+              'r', encoding='utf-8') as f:
+      previous = json.load(f)
+  except (OSError, ValueError):
+    return None
+  if previous.get('file_sha256') != content_hash:
+    return None
+  return previous.get('extractors')
+
+# with the blob store turned on and a content hash given, metadata is only
+# extracted once for each distinct file. a file with no metadata to find
+# counts as extracted too, so that it isn't tried again every run.
+def extract_metadata(report, content_hash=None, force=False):
+  version = extractor_version("metadata", report['file_type'])
+  store = blobs.get_store() if content_hash else None
+  if store and not force:
+    found, metadata = store.get_metadata(content_hash, version)
+    if found:
+      if metadata:
+        report[report['file_type'].lower()] = metadata
+      if version is not None:
+        record_extraction(report, "metadata")
+      return metadata
+
+  metadata = metadata_for(report)
+  if version is not None:
+    record_extraction(report, "metadata")
+  if store:
+    store.put_metadata(content_hash, metadata, version)
+  return metadata
 
-def extract_metadata(report):
+def metadata_for(report):
   report_path = path_for(report, report['file_type'])
 
   file_type_lower = report['file_type'].lower()
   if file_type_lower == "pdf":
     real_report_path = os.path.abspath(os.path.expandvars(os.path.join(utils.data_dir(), report_path)))
-    if utils.check_pdf_decryption(real_report_path):
+    inspection = utils.inspect_pdf(real_report_path)
+    if inspection['encrypted']:
       real_decrypted_path = real_report_path[:-4] + ".decrypted.pdf"
       decrypted_path = report_path[:-4] + ".decrypted.pdf"
       if os.path.isfile(real_decrypted_path) or utils.decrypt_pdf(real_report_path, real_decrypted_path):
         metadata = utils.metadata_from_pdf(decrypted_path)
       else:
         metadata = None
+    elif inspection['metadata']:
+      metadata = dict(inspection['metadata'])
     else:
+      # pdfrw couldn't read it, fall back to pdfinfo
       metadata = utils.metadata_from_pdf(report_path)
+    if inspection['attachments']:
+      logging.warn("\tattachments: %s" % ", ".join(inspection['attachments']))
+      metadata = dict(metadata or {})
+      metadata['attachments'] = inspection['attachments']
     if metadata:
       report['pdf'] = metadata
       return metadata
@@ -350,21 +632,53 @@ def extract_metadata(report):
     logging.warn("Unknown file type, don't know how to extract metadata!")
     return None
 
+# Text is only extracted again when it's missing or stale (see
+# stale_extractions), or when forced. Like extract_metadata, reuses text
+# already extracted from an identical file when the blob store is turned on.
+def extract_report(report, content_hash=None, force=False):
+  version = extractor_version("text", report['file_type'])
+  if version is None:
+    # no extractor for this kind of file, text_for will complain
+    return text_for(report)
+
+  text_path = text_path_for(report)
+  if not (force or "text" in stale_extractions(report)):
+    return text_path
+
+  real_text_path = os.path.abspath(os.path.expandvars(os.path.join(utils.data_dir(), text_path)))
+  store = blobs.get_store() if content_hash else None
+  if store and not force and store.has_text(content_hash, version):
+    store.link_text(content_hash, version, real_text_path)
+    record_extraction(report, "text")
+    return text_path
+
+  text_path = text_for(report)
+  if text_path and os.path.exists(real_text_path):
+    record_extraction(report, "text")
+    if store:
+      store.put_text(content_hash, version, real_text_path)
+  return text_path
+
+def text_path_for(report):
+  return "%s.txt" % os.path.splitext(path_for(report, report['file_type']))[0]
+
 # relies on putting text next to report_path
-def extract_report(report):
+def text_for(report):
   report_path = path_for(report, report['file_type'])
   real_report_path = os.path.abspath(os.path.expandvars(os.path.join(utils.data_dir(), report_path)))
 
-  text_path = "%s.txt" % os.path.splitext(report_path)[0]
+  text_path = text_path_for(report)
   real_text_path = os.path.abspath(os.path.expandvars(os.path.join(utils.data_dir(), text_path)))
 
-  if os.path.exists(real_text_path):
-    # This report has already had its text extracted
-    return text_path
+  # clear out old text first, so a failed extraction doesn't leave it looking
+  # current, and so tools don't write through a link into the blob store
+  if os.path.exists(real_text_path) and (text_path != report_path):
+    os.remove(real_text_path)
 
   file_type_lower = report['file_type'].lower()
   if file_type_lower == "pdf":
-    if utils.check_pdf_decryption(real_report_path):
+    # reuses the inspection done by extract_metadata
+    if utils.inspect_pdf(real_report_path)['encrypted']:
       real_decrypted_path = real_report_path[:-4] + ".decrypted.pdf"
       if os.path.isfile(real_decrypted_path) or utils.decrypt_pdf(real_report_path, real_decrypted_path):
         utils.text_from_pdf(real_decrypted_path, real_text_path)
@@ -403,7 +717,16 @@ def year_from(report):
   return int(report['published_on'].split("-")[0])
 
 # assume standard options for IG scrapers, since/year
+# computed once per run for the run's own options
 def year_range(options, archive):
+  context = utils.run_context()
+  if options is context.options:
+    if archive not in context.year_ranges:
+      context.year_ranges[archive] = compute_year_range(options, archive)
+    return list(context.year_ranges[archive])
+  return compute_year_range(options, archive)
+
+def compute_year_range(options, archive):
   this_year = datetime.datetime.now().year
 
   # --archive will use scraper's oldest year, if passed in.
@@ -0,0 +1,324 @@
+# persistent index of the reports saved under the data directory
+#
+# Keeps one row per (inspector, year, report_id) with the report's URLs, file
+# type, content hash and status, so that duplicate detection, QA scripts and
+# backups can query it instead of walking data/ on every run.
+#
+# The first time an inspector is looked up, its existing reports are imported
+# from disk once. After that, the first lookup in each process only checks
+# which report directories exist: rows for directories that have been deleted
+# or moved are dropped, and directories the manifest doesn't know about yet
+# are imported. Running with --rescan imports each inspector from scratch
+# instead, as does deleting the manifest file.
+
+import datetime
+import json
+import logging
+import os
+import sqlite3
+import threading
+
+from . import admin
+from . import utils
+
+STATUS_DOWNLOADED = "downloaded"
+STATUS_UNRELEASED = "unreleased"
+STATUS_METADATA_ONLY = "metadata_only"
+STATUS_FAILED = "failed"
+
+# every status that has a report.json on disk
+SAVED_STATUSES = (STATUS_DOWNLOADED, STATUS_UNRELEASED, STATUS_METADATA_ONLY)
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS reports (
+  inspector TEXT NOT NULL,
+  year INTEGER NOT NULL,
+  report_id TEXT NOT NULL COLLATE NOCASE,
+  url TEXT,
+  landing_url TEXT,
+  file_type TEXT,
+  content_hash TEXT,
+  status TEXT,
+  updated_at TEXT,
+  file_size INTEGER,
+  file_mtime_ns INTEGER,
+  PRIMARY KEY (inspector, year, report_id)
+);
+CREATE INDEX IF NOT EXISTS reports_report_id ON reports (inspector, report_id);
+CREATE INDEX IF NOT EXISTS reports_landing_url ON reports (inspector, landing_url);
+CREATE INDEX IF NOT EXISTS reports_content_hash ON reports (content_hash);
+CREATE TABLE IF NOT EXISTS scanned (
+  inspector TEXT PRIMARY KEY
+);
+"""
+
+COLUMNS = ("inspector", "year", "report_id", "url", "landing_url", "file_type",
+           "content_hash", "status", "updated_at", "file_size", "file_mtime_ns")
+
+# columns added since the first version of the schema, added to older
+# manifests in place
+ADDED_COLUMNS = (
+  ("file_size", "INTEGER"),
+  ("file_mtime_ns", "INTEGER"),
+)
+
+
+class Manifest(object):
+  def __init__(self, path, data_dir):
+    self.path = path
+    self.data_dir = data_dir
+    self.lock = threading.RLock()
+    self.connection = None
+    self.pid = None
+    # (pid, inspector) pairs already checked against disk
+    self.synced = set()
+
+  def connect(self):
+    # sqlite connections can't be carried across a fork, so worker processes
+    # started by ./igs --workers open their own
+    if self.connection is None or self.pid != os.getpid():
+      if os.path.dirname(self.path):
+        utils.mkdir_p(os.path.dirname(self.path))
+      self.connection = sqlite3.connect(self.path, timeout=60,
+                                        check_same_thread=False)
+      self.connection.execute("PRAGMA journal_mode=WAL")
+      self.connection.executescript(SCHEMA)
+      existing = set(row[1] for row in
+                     self.connection.execute("PRAGMA table_info(reports)"))
+      for name, column_type in ADDED_COLUMNS:
+        if name not in existing:
+          self.connection.execute(
+            "ALTER TABLE reports ADD COLUMN %s %s" % (name, column_type))
+      self.pid = os.getpid()
+    return self.connection
+
+  def execute(self, sql, params=()):
+    with self.lock:
+      connection = self.connect()
+      with connection:
+        return connection.execute(sql, params).fetchall()
+
+  def ensure_scanned(self, inspector):
+    key = (os.getpid(), inspector)
+    if key in self.synced:
+      return
+    rows = self.execute("SELECT 1 FROM scanned WHERE inspector = ?",
+                        (inspector,))
+    if not rows or utils.run_context().options.get('rescan'):
+      self.import_from_disk(inspector)
+    else:
+      self.sync_with_disk(inspector)
+    self.synced.add(key)
+
+  # (year, report_id) of every report directory an inspector has on disk
+  def directories_on_disk(self, inspector):
+    found = []
+    inspector_path = os.path.join(self.data_dir, inspector)
+    if os.path.isdir(inspector_path):
+      for year_folder in os.listdir(inspector_path):
+        year_path = os.path.join(inspector_path, year_folder)
+        if not (year_folder.isdigit() and os.path.isdir(year_path)):
+          continue
+        for report_id in os.listdir(year_path):
+          if os.path.isdir(os.path.join(year_path, report_id)):
+            found.append((int(year_folder), report_id))
+    return found
+
+  # import of all of an inspector's reports on disk, replacing whatever the
+  # manifest had for it before
+  def import_from_disk(self, inspector):
+    logging.info("[%s] Importing reports on disk into the manifest" % inspector)
+    rows = [row_from_disk(inspector, year, report_id,
+                          self.report_dir(inspector, year, report_id))
+            for year, report_id in self.directories_on_disk(inspector)]
+
+    with self.lock:
+      connection = self.connect()
+      with connection:
+        connection.execute("DELETE FROM reports WHERE inspector = ?",
+                           (inspector,))
+        self.insert(connection, rows)
+        connection.execute("INSERT OR IGNORE INTO scanned VALUES (?)",
+                           (inspector,))
+
+  # drop rows whose report directory is gone, and import directories that
+  # have no row. rows are read before disk is listed, so a report saved by
+  # another process in the meantime is never mistaken for a deleted one.
+  def sync_with_disk(self, inspector):
+    known = set((year, report_id) for year, report_id in self.execute(
+      "SELECT year, report_id FROM reports WHERE inspector = ?", (inspector,)))
+    on_disk = set(self.directories_on_disk(inspector))
+
+    gone = known - on_disk
+    new = [row_from_disk(inspector, year, report_id,
+                         self.report_dir(inspector, year, report_id))
+           for year, report_id in sorted(on_disk - known)]
+    if gone:
+      logging.info("[%s] Dropping %i reports no longer on disk from the manifest" %
+                   (inspector, len(gone)))
+    with self.lock:
+      connection = self.connect()
+      with connection:
+        connection.executemany(
+          "DELETE FROM reports WHERE inspector = ? AND year = ? AND report_id = ?",
+          [(inspector, year, report_id) for year, report_id in gone])
+        self.insert(connection, new)
+
+  def insert(self, connection, rows):
+    connection.executemany(
+      "INSERT OR IGNORE INTO reports (%s) VALUES (%s)" %
+      (", ".join(COLUMNS), ", ".join("?" * len(COLUMNS))), rows)
+
+  def report_dir(self, inspector, year, report_id):
+    return os.path.join(self.data_dir, inspector, str(year), report_id)
+
+  # record a report as it's saved. a status or hash of None keeps whatever
+  # was recorded before, so a dry run doesn't forget a downloaded file.
+  # `stat` is the downloaded file's os.stat, see hash_for.
+  def record(self, report, status=None, content_hash=None, stat=None):
+    key = (report['inspector'], int(report['year']), report['report_id'])
+    file_size = file_mtime_ns = None
+    if stat:
+      file_size, file_mtime_ns = stat.st_size, stat.st_mtime_ns
+    with self.lock:
+      existing = self.execute(
+        "SELECT status, content_hash, file_size, file_mtime_ns FROM reports "
+        "WHERE inspector = ? AND year = ? AND report_id = ?", key)
+      if existing:
+        status = status or existing[0][0]
+        if not content_hash:
+          content_hash, file_size, file_mtime_ns = existing[0][1:]
+      self.execute(
+        "INSERT OR REPLACE INTO reports (%s) VALUES (%s)" %
+        (", ".join(COLUMNS), ", ".join("?" * len(COLUMNS))),
+        key + (report.get('url'), report.get('landing_url'),
+               report.get('file_type'), content_hash,
+               status or STATUS_METADATA_ONLY, now(), file_size, file_mtime_ns))
+
+  # the content hash recorded for a report's file, if the file's size and
+  # mtime are still what they were then, so it needn't be read again
+  def hash_for(self, report, stat):
+    rows = self.execute(
+      "SELECT content_hash FROM reports WHERE inspector = ? AND year = ? "
+      "AND report_id = ? AND file_size = ? AND file_mtime_ns = ?",
+      (report['inspector'], int(report['year']), report['report_id'],
+       stat.st_size, stat.st_mtime_ns))
+    if rows and rows[0][0]:
+      return rows[0][0]
+    return None
+
+  # whether a report has already been downloaded and needs no more fetching,
+  # looked up by report ID and/or landing page URL. unreleased reports don't
+  # count, so they're checked again until they come out, and neither does a
+  # row whose file is no longer on disk.
+  def is_known(self, inspector, report_id=None, landing_url=None):
+    clauses = []
+    params = [inspector, STATUS_DOWNLOADED]
+    if report_id:
+      clauses.append("report_id = ?")
+      params.append(report_id)
+    if landing_url:
+      clauses.append("landing_url = ?")
+      params.append(landing_url)
+    if not clauses:
+      return False
+
+    self.ensure_scanned(inspector)
+    rows = self.execute(
+      "SELECT year, report_id, file_type FROM reports WHERE inspector = ? "
+      "AND status = ? AND (%s)" % " OR ".join(clauses), params)
+    for year, report_id, file_type in rows:
+      report_dir = self.report_dir(inspector, year, report_id)
+      if os.path.isfile(os.path.join(report_dir, "report.%s" % file_type)):
+        return True
+      if not os.path.isdir(report_dir):
+        self.execute(
+          "DELETE FROM reports WHERE inspector = ? AND year = ? AND report_id = ?",
+          (inspector, year, report_id))
+    return False
+
+  # (report_id, year) pairs for an inspector, oldest years first
+  def years_for(self, inspector):
+    self.ensure_scanned(inspector)
+    return self.execute(
+      "SELECT report_id, year FROM reports WHERE inspector = ? "
+      "ORDER BY year, report_id", (inspector,))
+
+  def inspectors(self):
+    names = set()
+    if os.path.isdir(self.data_dir):
+      for name in os.listdir(self.data_dir):
+        if os.path.isdir(os.path.join(self.data_dir, name)):
+          names.add(name)
+    for row in self.execute("SELECT DISTINCT inspector FROM reports"):
+      names.add(row[0])
+    return sorted(names)
+
+  # (inspector, year, report_id) tuples, optionally limited to one inspector,
+  # one year, a set of statuses and/or a set of file types
+  def reports(self, inspector=None, year=None, statuses=None, file_types=None):
+    inspectors = [inspector] if inspector else self.inspectors()
+    results = []
+    for name in inspectors:
+      self.ensure_scanned(name)
+      sql = "SELECT inspector, year, report_id FROM reports WHERE inspector = ?"
+      params = [name]
+      if year:
+        sql += " AND year = ?"
+        params.append(int(year))
+      if statuses:
+        sql += " AND status IN (%s)" % ", ".join("?" * len(statuses))
+        params.extend(statuses)
+      if file_types:
+        sql += " AND lower(file_type) IN (%s)" % ", ".join("?" * len(file_types))
+        params.extend([file_type.lower() for file_type in file_types])
+      sql += " ORDER BY year, report_id"
+      results.extend(self.execute(sql, params))
+    return results
+
+
+def row_from_disk(inspector, year, report_id, report_path):
+  url = landing_url = file_type = None
+  status = STATUS_FAILED
+
+  json_path = os.path.join(report_path, "report.json")
+  if os.path.isfile(json_path):
+    try:
+      with open(json_path, 'r', encoding='utf-8') as f:
+        report = json.load(f)
+    except ValueError:
+      report = {}
+    url = report.get('url')
+    landing_url = report.get('landing_url')
+    file_type = report.get('file_type')
+
+    if report.get('unreleased'):
+      status = STATUS_UNRELEASED
+    elif file_type and os.path.isfile(
+        os.path.join(report_path, "report.%s" % file_type)):
+      status = STATUS_DOWNLOADED
+    else:
+      status = STATUS_METADATA_ONLY
+
+  return (inspector, year, report_id, url, landing_url, file_type, None,
+          status, now(), None, None)
+
+
+def now():
+  return datetime.datetime.now().strftime("%Y-%m-%dT%H:%M:%S")
+
+
+# assumes working dir is the root dir, like utils.data_dir()
+def manifest_path():
+  if admin.config and admin.config.get('manifest_path'):
+    return admin.config.get('manifest_path')
+  return os.path.join(utils.cache_dir(), "manifest.sqlite3")
+
+
+_manifest = None
+
+def get_manifest():
+  global _manifest
+  if _manifest is None:
+    _manifest = Manifest(manifest_path(), utils.data_dir())
+  return _manifest
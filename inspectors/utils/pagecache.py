@@ -0,0 +1,62 @@
+# in-memory cache of pages fetched during one scraper run
+#
+# Scrapers often fetch the same page more than once in a run: the first page
+# of a listing to count pages, then again in the main loop, or pager pages
+# that every other page links back to. Each run (see utils.RunContext) gets
+# its own PageCache, so repeat fetches within the run are free, and nothing
+# goes stale across runs.
+#
+# Bounded in both entries and total size, least recently used first out:
+#
+#   page_cache:
+#     entries: 256
+#     megabytes: 64
+#
+# or `page_cache: false` to turn it off.
+
+import collections
+import threading
+
+DEFAULT_ENTRIES = 256
+DEFAULT_MEGABYTES = 64
+
+
+class PageCache(object):
+  def __init__(self, max_entries=DEFAULT_ENTRIES, max_megabytes=DEFAULT_MEGABYTES):
+    self.max_entries = max_entries
+    self.max_bytes = max_megabytes * 1024 * 1024
+    self.entries = collections.OrderedDict()
+    self.size = 0
+    self.hits = 0
+    self.lock = threading.Lock()
+
+  def get(self, key):
+    with self.lock:
+      if key not in self.entries:
+        return None
+      self.entries.move_to_end(key)
+      self.hits += 1
+      return self.entries[key][0]
+
+  # size is in bytes, roughly
+  def put(self, key, value, size):
+    if size > self.max_bytes:
+      return
+    with self.lock:
+      if key in self.entries:
+        self.size -= self.entries.pop(key)[1]
+      self.entries[key] = (value, size)
+      self.size += size
+      while self.entries and (len(self.entries) > self.max_entries or
+                              self.size > self.max_bytes):
+        _, (_, evicted_size) = self.entries.popitem(last=False)
+        self.size -= evicted_size
+
+
+# a new cache per the config, or None if it's turned off
+def from_config(config):
+  if config is False:
+    return None
+  config = config if isinstance(config, dict) else {}
+  return PageCache(int(config.get('entries', DEFAULT_ENTRIES)),
+                   int(config.get('megabytes', DEFAULT_MEGABYTES)))
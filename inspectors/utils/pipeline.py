@@ -0,0 +1,97 @@
+# background download/extraction for inspector.save_report
+#
+# save_report validates a report in the scraper's own thread, then hands the
+# slow part (download, PDF checks, metadata and text extraction, writing JSON)
+# to a bounded pool of worker threads, so the scraper can keep parsing listing
+# pages in the meantime. If the queue is full, save_report blocks until a
+# worker frees up, which keeps memory use and politeness in check.
+#
+# utils.run calls join() after each scraper finishes, so every report is
+# written, and every error logged against its scraper, before moving on.
+
+import contextvars
+import logging
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+from . import admin
+
+DEFAULT_WORKERS = 4
+PENDING_PER_WORKER = 4
+
+
+class SavePipeline(object):
+  def __init__(self, workers, max_pending=None):
+    self.workers = workers
+    self.executor = ThreadPoolExecutor(max_workers=workers)
+    self.slots = threading.BoundedSemaphore(max_pending or
+                                            workers * PENDING_PER_WORKER)
+    self.futures = []
+    self.lock = threading.Lock()
+
+  def submit(self, scraper, function, *args):
+    self.slots.acquire()
+    try:
+      # carry the run context (see utils.run) over to the worker thread
+      context = contextvars.copy_context()
+      future = self.executor.submit(context.run, self.run_task, scraper,
+                                    function, *args)
+    except Exception:
+      self.slots.release()
+      raise
+    with self.lock:
+      self.futures.append(future)
+    return future
+
+  def run_task(self, scraper, function, *args):
+    try:
+      return function(*args)
+    except Exception as exception:
+      # log from inside the worker, while the traceback is still available
+      admin.log_exception(exception, scraper)
+      return False
+    finally:
+      self.slots.release()
+
+  # wait for every queued report, returns how many of them failed
+  def join(self):
+    with self.lock:
+      futures, self.futures = self.futures, []
+    failures = 0
+    for future in futures:
+      if future.result() is False:
+        failures += 1
+    if futures:
+      logging.info("## Finished %i queued reports (%i failed)" %
+                   (len(futures), failures))
+    return failures
+
+  def shutdown(self):
+    self.join()
+    self.executor.shutdown(wait=True)
+
+
+_pipeline = None
+
+# the shared pipeline, or None when reports should be saved synchronously
+# (--save_workers=0)
+def get_pipeline(options):
+  global _pipeline
+  workers = options.get('save_workers', DEFAULT_WORKERS)
+  if workers is True:
+    workers = DEFAULT_WORKERS
+  workers = int(workers or 0)
+  if workers < 1:
+    return None
+
+  if _pipeline is None or _pipeline.workers != workers:
+    if _pipeline is not None:
+      _pipeline.shutdown()
+    _pipeline = SavePipeline(workers)
+  return _pipeline
+
+
+def join():
+  if _pipeline is None:
+    return 0
+  return _pipeline.join()
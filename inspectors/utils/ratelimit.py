@@ -0,0 +1,129 @@
+# per-host rate limiting for outgoing HTTP requests
+#
+# Every host gets its own token bucket, so scrapers hitting unrelated servers
+# (oig.hhs.gov, dodig.mil, gao.gov...) never throttle each other, and one slow
+# host can't hold up requests to the rest.
+#
+# Rates are configured in admin.yml, in requests per minute:
+#
+#   rate_limits:
+#     default: 120
+#     burst: 1
+#     hosts:
+#       gao.gov: 60
+#
+# A configured host also covers its subdomains, e.g. "gao.gov" applies to
+# "www.gao.gov", and they share one bucket.
+#
+# Under `./igs --workers`, the buckets live in a multiprocessing.Manager
+# started by the parent (see share()), so scrapers in different processes
+# hitting the same host (gao and gaoreports, say) stay within one limit
+# between them, rather than each getting the full rate.
+
+import threading
+import time
+import urllib.parse
+
+DEFAULT_REQUESTS_PER_MINUTE = 120
+DEFAULT_BURST = 1
+
+
+class TokenBucket(object):
+  def __init__(self, requests_per_minute, burst=DEFAULT_BURST):
+    self.rate = requests_per_minute / 60.0
+    self.capacity = max(burst, 1)
+    self.tokens = self.capacity
+    self.updated = time.monotonic()
+    self.lock = threading.Lock()
+
+  # blocks until a request may be made
+  def acquire(self):
+    if self.rate <= 0:
+      return
+
+    with self.lock:
+      now = time.monotonic()
+      self.tokens = min(self.capacity,
+                        self.tokens + (now - self.updated) * self.rate)
+      self.updated = now
+
+      # reserve a token, going into debt if necessary, and sleep off the debt
+      # outside of the lock so other callers can queue up behind us
+      self.tokens -= 1
+      wait = -self.tokens / self.rate if self.tokens < 0 else 0
+
+    if wait > 0:
+      time.sleep(wait)
+
+
+# a TokenBucket whose state is kept in a Manager dict, under its key, so
+# every process using the same dict and lock draws on the same tokens.
+# time.monotonic() is system-wide, so it's comparable across processes.
+class SharedTokenBucket(object):
+  def __init__(self, key, requests_per_minute, burst, state, lock):
+    self.key = key
+    self.rate = requests_per_minute / 60.0
+    self.capacity = max(burst, 1)
+    self.state = state
+    self.lock = lock
+
+  def acquire(self):
+    if self.rate <= 0:
+      return
+
+    with self.lock:
+      now = time.monotonic()
+      tokens, updated = self.state.get(self.key, (self.capacity, now))
+      tokens = min(self.capacity, tokens + max(now - updated, 0) * self.rate)
+      tokens -= 1
+      self.state[self.key] = (tokens, now)
+      wait = -tokens / self.rate if tokens < 0 else 0
+
+    if wait > 0:
+      time.sleep(wait)
+
+
+class HostRateLimiter(object):
+  def __init__(self, config=None):
+    config = config or {}
+    self.default = config.get("default", DEFAULT_REQUESTS_PER_MINUTE)
+    self.burst = config.get("burst", DEFAULT_BURST)
+    self.hosts = config.get("hosts") or {}
+    self.buckets = {}
+    self.lock = threading.Lock()
+    self.shared = None
+
+  # state for handing to other processes' limiters through use_shared(), so
+  # that they all draw on the same buckets
+  def share(self, manager):
+    self.use_shared((manager.dict(), manager.Lock()))
+    return self.shared
+
+  def use_shared(self, shared):
+    with self.lock:
+      self.shared = shared
+      self.buckets = {}
+
+  # longest configured domain that this host falls under, or the host itself
+  def key_for(self, host):
+    matches = [domain for domain in self.hosts
+               if host == domain or host.endswith("." + domain)]
+    if matches:
+      return max(matches, key=len)
+    return host
+
+  def bucket_for(self, url):
+    host = (urllib.parse.urlparse(url).hostname or "").lower()
+    key = self.key_for(host)
+    with self.lock:
+      if key not in self.buckets:
+        rate = self.hosts.get(key, self.default)
+        if self.shared:
+          state, lock = self.shared
+          self.buckets[key] = SharedTokenBucket(key, rate, self.burst, state, lock)
+        else:
+          self.buckets[key] = TokenBucket(rate, self.burst)
+      return self.buckets[key]
+
+  def wait(self, url):
+    self.bucket_for(url).acquire()
@@ -0,0 +1,36 @@
+# counters and timers for ./benchmark
+#
+# Kept cheap enough to leave on all the time: a Counter update under a lock.
+# Timers are in seconds, and work from the save pipeline's threads too.
+
+import collections
+import contextlib
+import threading
+import time
+
+counters = collections.Counter()
+lock = threading.Lock()
+
+
+def count(name, amount=1):
+  with lock:
+    counters[name] += amount
+
+
+@contextlib.contextmanager
+def timer(name):
+  start = time.perf_counter()
+  try:
+    yield
+  finally:
+    count(name, time.perf_counter() - start)
+
+
+def snapshot():
+  with lock:
+    return dict(counters)
+
+
+def reset():
+  with lock:
+    counters.clear()
@@ -1,68 +1,135 @@
 import os, os.path, errno, sys, traceback, subprocess
+import collections
+import contextlib
+import copy
+import contextvars
+import threading
 import re, html.entities
 import json
+import hashlib
+import mmap
 import logging
 import yaml
 from bs4 import BeautifulSoup
+import lxml.html
 from datetime import datetime
 import requests
 import urllib.parse
 import io
-import gzip
 import certifi
 import docx
 import zipfile
+import zlib
 from urllib.parse import urljoin
-import inspect
 import pdfrw
 
 from . import admin
+from . import fetch
+from . import fixtures
+from . import httpcache
+from . import pagecache
+from . import pipeline
+from . import ratelimit
+from . import stats
 
 logging.getLogger("pdfrw").setLevel(logging.CRITICAL)
 
-# scraper should be instantiated at class-load time, so that it can rate limit appropriately
 import scrapelib
-scraper = scrapelib.Scraper(requests_per_minute=120, retry_attempts=3)
+
+class HostThrottledScraper(scrapelib.Scraper):
+  """Scraper that rate limits each host separately, instead of using
+  scrapelib's single global limit."""
+
+  def __init__(self, rate_limiter, **kwargs):
+    super(HostThrottledScraper, self).__init__(requests_per_minute=0, **kwargs)
+    self.rate_limiter = rate_limiter
+    self.fixtures = None
+    self.fixtures_mode = None
+
+  # record responses to, or replay them from, a fixtures.FixtureArchive
+  def use_fixtures(self, archive, mode):
+    self.fixtures = archive
+    self.fixtures_mode = mode
+    if mode == "replay":
+      # a missing fixture won't turn up by trying again
+      self.retry_attempts = 0
+
+  def get_adapter(self, url):
+    adapter = super(HostThrottledScraper, self).get_adapter(url)
+    if self.fixtures_mode == "replay":
+      return fixtures.ReplayAdapter(self.fixtures)
+    elif self.fixtures_mode == "record":
+      return fixtures.RecordingAdapter(self.fixtures, adapter)
+    return adapter
+
+  # a 416 to a Range request is an answer, not a failure worth retrying:
+  # download_binary uses it to tell that a .part is already complete
+  def accept_response(self, response, **kwargs):
+    if response.status_code == 416 and "Range" in response.request.headers:
+      return True
+    return super(HostThrottledScraper, self).accept_response(response, **kwargs)
+
+  # throttled here rather than in request(), so that every attempt counts
+  # against the host's limit, scrapelib's retries and redirects included
+  def send(self, request, **kwargs):
+    if self.fixtures_mode != "replay":
+      self.rate_limiter.wait(request.url)
+    return super(HostThrottledScraper, self).send(request, **kwargs)
+
+  def request(self, method, url, *args, **kwargs):
+    response = super(HostThrottledScraper, self).request(method, url, *args, **kwargs)
+    stats.count("requests")
+    # streamed bodies are counted as they're read
+    if not kwargs.get('stream'):
+      stats.count("bytes", len(response.content))
+    return response
+
+# scraper should be instantiated at class-load time, so that it can rate limit appropriately
+rate_limiter = ratelimit.HostRateLimiter(admin.config and admin.config.get('rate_limits'))
+scraper = HostThrottledScraper(rate_limiter, retry_attempts=3)
 scraper.user_agent = "unitedstates/inspectors-general (https://github.com/unitedstates/inspectors-general)"
 scraper.timeout = 60
 
+# "file not found" pages that some sites serve with a 200 status code, by
+# base domain. Any signature turning up in the first SOFT_404_PEEK_BYTES of
+# an HTML page (after decompression) marks the page as a 404. download()
+# checks again whatever the adapter below can't see (other content types,
+# binary files, pages from the HTTP cache) before anything is written, and
+# `./qa soft_404` scans saved reports against the same signatures.
+SOFT_404_BODY_SIGNATURES = {}
+SOFT_404_PEEK_BYTES = 10240
+# base domain => one compiled pattern for all of its signatures
+soft_404_patterns = {}
+
+# the compiled bytes pattern for a URL's domain's signatures, or None
+def soft_404_pattern_for(url):
+  domain = urllib.parse.urlparse(url)[1].split(':')[0]
+  base_domain = ".".join(domain.split(".")[-2:])
+  return soft_404_patterns.get(base_domain)
+
+# whether the first `limit` bytes of a file match a soft-404 pattern, read
+# through mmap so that nothing past them is ever read in
+def file_matches_soft_404(path, pattern, limit=SOFT_404_PEEK_BYTES):
+  size = os.path.getsize(path)
+  if not size:
+    return False
+  with open(path, 'rb') as f:
+    with mmap.mmap(f.fileno(), min(size, limit), access=mmap.ACCESS_READ) as head:
+      return pattern.search(head) is not None
+
 class Soft404HttpAdapter(requests.adapters.HTTPAdapter):
   """Transport adapter that checks all responses against a blacklist of "file
   not found" pages that are served with 200 status codes."""
 
   SOFT_404_URLS_RE = re.compile(r"^(http://www\.dodig\.mil/errorpages/index\.html|http://www\.fec\.gov/404error\.shtml|http://www\.gpo\.gov/maintenance/error\.htm)$")
-  SOFT_404_BODY_SIGNATURES = {
-    "cftc.gov": b"<title>404 Page Not Found - CFTC</title>",
-    "cpb.org": b"<title>CPB: Page Not Found</title>",
-    "ncua.gov": b"Redirect.aspx?404",
-    "si.edu": b"<title>Page Not Found Smithsonian</title>",
-  }
 
   def build_response(self, req, resp):
-    domain = urllib.parse.urlparse(req.url)[1].split(':')[0]
-    base_domain = ".".join(domain.split(".")[-2:])
-    if base_domain in self.SOFT_404_BODY_SIGNATURES:
-      if resp.getheader("Content-Type") in ["text/html; charset=utf-8",
-                                            "text/html"]:
-        data = resp.data
-        headers = resp.headers
-        if resp.getheader("Content-Encoding") == "gzip":
-          decompressed_data = gzip.decompress(data)
-        else:
-          decompressed_data = data
-        if resp.getheader("Transfer-Encoding") == "chunked":
-          headers.pop("Transfer-Encoding")
-        body = io.BytesIO(data)
-        resp = requests.packages.urllib3.response.HTTPResponse(
-                body=body,
-                headers=headers,
-                status=resp.status,
-                version=resp.version,
-                reason=resp.reason,
-                strict=resp.strict,
-                preload_content=False,
-        )
-        if decompressed_data.find(self.SOFT_404_BODY_SIGNATURES[base_domain], 0, 10240) != -1:
+    pattern = soft_404_pattern_for(req.url)
+    if pattern:
+      content_type = resp.headers.get("Content-Type")
+      if content_type in ["text/html; charset=utf-8", "text/html"]:
+        head, resp = peek_response(resp)
+        if pattern.search(head):
           result = super(Soft404HttpAdapter, self).build_response(req, resp)
           result.status_code = 404 # tells scrapelib to not retry
           return result
@@ -74,20 +141,97 @@ class Soft404HttpAdapter(requests.adapters.HTTPAdapter):
 
     return result
 
-scraper.mount("http://www.cftc.gov/", Soft404HttpAdapter())
-scraper.mount("http://cftc.gov/", Soft404HttpAdapter())
-scraper.mount("http://www.dodig.mil/", Soft404HttpAdapter())
-scraper.mount("http://dodig.mil/", Soft404HttpAdapter())
-scraper.mount("http://www.fec.gov/", Soft404HttpAdapter())
-scraper.mount("http://fec.gov/", Soft404HttpAdapter())
-scraper.mount("http://www.gpo.gov/", Soft404HttpAdapter())
-scraper.mount("http://gpo.gov/", Soft404HttpAdapter())
-scraper.mount("http://www.cpb.org/", Soft404HttpAdapter())
-scraper.mount("http://cpb.org/", Soft404HttpAdapter())
-scraper.mount("http://www.ncua.gov/", Soft404HttpAdapter())
-scraper.mount("http://ncua.gov/", Soft404HttpAdapter())
-scraper.mount("http://www.si.edu/", Soft404HttpAdapter())
-scraper.mount("http://si.edu/", Soft404HttpAdapter())
+class PeekedStream(io.RawIOBase):
+  """Raw stream that gives back the bytes already peeked at from a response,
+  then carries on reading the rest of it as it's asked for."""
+
+  def __init__(self, head, response):
+    self.head = head
+    self.response = response
+
+  def readable(self):
+    return True
+
+  def readinto(self, buffer):
+    if self.head:
+      data, self.head = self.head[:len(buffer)], self.head[len(buffer):]
+    else:
+      data = self.response.read(len(buffer), decode_content=False)
+    buffer[:len(data)] = data
+    return len(data)
+
+  def close(self):
+    self.response.release_conn()
+    super(PeekedStream, self).close()
+
+# read just enough of a streaming urllib3 response to see the start of its
+# (decompressed) body. returns that, and a response to use in place of the
+# original one, which still streams the whole body.
+def peek_response(resp, limit=SOFT_404_PEEK_BYTES):
+  encoding = (resp.headers.get("Content-Encoding") or "").lower()
+  if encoding == "gzip":
+    decompressor = zlib.decompressobj(16 + zlib.MAX_WBITS)
+  elif encoding == "deflate":
+    decompressor = zlib.decompressobj()
+  else:
+    decompressor = None
+
+  raw = b""
+  head = b""
+  while len(head) < limit:
+    chunk = resp.read(limit, decode_content=False)
+    if not chunk:
+      break
+    raw += chunk
+    if decompressor:
+      try:
+        head += decompressor.decompress(chunk, limit - len(head))
+      except zlib.error:
+        break
+    else:
+      head += chunk
+
+  headers = resp.headers
+  # the raw stream below has already been de-chunked
+  if "Transfer-Encoding" in headers:
+    headers.pop("Transfer-Encoding")
+  body = io.BufferedReader(PeekedStream(raw, resp))
+  peeked = requests.packages.urllib3.response.HTTPResponse(
+    body=body,
+    headers=headers,
+    status=resp.status,
+    version=resp.version,
+    reason=resp.reason,
+    preload_content=False,
+    original_response=getattr(resp, "_original_response", None),
+  )
+  return head[:limit], peeked
+
+# teach the scraper about another site's "file not found" page. requests to
+# the domain (and www.) are checked from then on.
+def register_soft_404(domain, signature):
+  signatures = SOFT_404_BODY_SIGNATURES.setdefault(domain, [])
+  signatures.append(signature)
+  soft_404_patterns[domain] = re.compile(
+    b"|".join(re.escape(signature) for signature in signatures))
+  for prefix in ("http://", "http://www.", "https://", "https://www."):
+    scraper.mount("%s%s/" % (prefix, domain), Soft404HttpAdapter())
+
+register_soft_404("cftc.gov", b"<title>404 Page Not Found - CFTC</title>")
+register_soft_404("cpb.org", b"<title>CPB: Page Not Found</title>")
+register_soft_404("dodig.mil", b"<title>DoD IG - Error Message</title>")
+register_soft_404("gpo.gov", b"<title>Maintenance</title>")
+register_soft_404("ncua.gov", b"Redirect.aspx?404")
+register_soft_404("ncua.gov", b"That page was not found.&#160; If possible "
+                              b"we will redirect you to that content now.")
+register_soft_404("si.edu", b"<title>Page Not Found Smithsonian</title>")
+
+# generic error page titles, any of these sites might serve one
+for domain in ("cftc.gov", "cpb.org", "dodig.mil", "fec.gov", "gpo.gov",
+               "ncua.gov", "si.edu"):
+  for signature in (b"<title>Page Not Found</title>",
+                    b"<title>404: NOT FOUND</title>", b"<title>404</title>"):
+    register_soft_404(domain, signature)
 
 class CipherListAdapter(requests.adapters.HTTPAdapter):
   def __init__(self, ciphers):
@@ -180,20 +324,83 @@ META_CHARSETS = {
 }
 
 # will pass correct options on to individual scrapers whether
-# run through ./igs or individually, because argv[1:] is the same
-def run(run_method, additional=None):
-  cli_options = options()
+# run through ./igs or individually, because argv[1:] is the same.
+# a runner can also hand over options of its own with run_options, to run
+# several scrapers in one process without touching sys.argv.
+def run(run_method, additional=None, run_options=None, scraper_slug=None):
+  if run_options is None:
+    cli_options = options()
+  else:
+    cli_options = dict(run_options)
   configure_logging(cli_options)
 
   if additional:
     cli_options.update(additional)
 
+  fixtures.configure(scraper, cli_options)
+
+  context = RunContext(cli_options, scraper_slug or slug_for(run_method))
+  token = _run_context.set(context)
   try:
     return run_method(cli_options)
   except Exception as exception:
     admin.log_exception(exception)
+  finally:
+    # wait for reports still being downloaded and extracted in the background
+    pipeline.join()
+    _run_context.reset(token)
+
+
+class RunContext(object):
+  """What's fixed for the length of one scraper run: its parsed options,
+  the year ranges computed from them, the data directory, which scraper
+  is running, and the pages it has fetched so far (see pagecache.py).
+  Built once by utils.run, reachable through run_context()."""
+
+  def __init__(self, options, scraper=None):
+    self.options = options
+    self.scraper = scraper
+    self.data_dir = data_dir()
+    self.year_ranges = {}
+    self.pages = pagecache.from_config(admin.config and admin.config.get('page_cache'))
+
+
+_run_context = contextvars.ContextVar("run_context", default=None)
+_default_context = None
+
+# the context of the run in progress, or, outside of utils.run, one built
+# once from the command line
+def run_context():
+  global _default_context
+  context = _run_context.get()
+  if context is None:
+    if _default_context is None:
+      _default_context = RunContext(options())
+    context = _default_context
+  return context
+
+# the slug of the scraper that's running, e.g. for logging errors against.
+# comes from the run context, and only outside of utils.run falls back to
+# the file of the function `depth` frames up (by default, our caller's caller)
+def calling_scraper(depth=2):
+  scraper_slug = run_context().scraper
+  if scraper_slug:
+    return scraper_slug
+  filename = sys._getframe(depth).f_code.co_filename
+  return os.path.splitext(os.path.basename(filename))[0]
+
+# e.g. "usps" for inspectors/usps.py, whether imported or run directly
+def slug_for(run_method):
+  module = sys.modules.get(getattr(run_method, "__module__", None))
+  filename = getattr(module, "__file__", None)
+  if filename:
+    return os.path.splitext(os.path.basename(filename))[0]
+  return None
 
 
+# file types that get saved as HTML pages
+FILE_EXTENSIONS_HTML = ("htm", "html", "shtml", "cfm", "php", "asp", "aspx")
+
 # read options from the command line
 #   e.g. ./inspectors/usps.py --since=2012-03-04 --debug
 #     => {"since": "2012-03-04", "debug": True}
@@ -204,19 +411,30 @@ AVAILABLE_OPTIONS = (
   "debug",
   "dry_run",
   "end",
+  "file_type",
+  "force",
   "ig",
+  "kind",
   "limit",
   "log",
   "only",
   "pages",
   "quick",
+  "record",
+  "replay",
   "report_id",
+  "rescan",
+  "rows",
   "safe",
+  "save_workers",
   "since",
   "skip_downloaded",
   "start",
+  "stop_at_known",
   "topics",
   "types",
+  "version",
+  "workers",
   "year",
 )
 
@@ -261,11 +479,39 @@ def configure_logging(options=None):
   logging.basicConfig(format='%(message)s', level=log_level.upper())
 
 
+_fresh = contextvars.ContextVar("fresh", default=False)
+
+# Inside `with fresh():`, pages are fetched from the web again even if they
+# were fetched earlier in the run, skipping both the run's page cache (which
+# is still updated) and revalidation against the HTTP cache. For deliberate
+# refetches: listings that shuffle between requests, or pages that came back
+# with a temporary error. fresh(False) is a no-op, for retry loops.
+@contextlib.contextmanager
+def fresh(enabled=True):
+  token = _fresh.set(enabled or _fresh.get())
+  try:
+    yield
+  finally:
+    _fresh.reset(token)
+
+# key for the run's page cache. cache-busting parameters (like usps's
+# &t=<time>) are left out, so they don't defeat it.
+def page_key(method, url, *rest):
+  return (method, httpcache.without_cache_busters(url)) + rest
+
 # download the data at url
 def download(url, destination=None, options=None, scraper_slug=None):
   options = {} if not options else options
   cache = options.get('cache', True) # default to caching
   binary = options.get('binary', False) # default to assuming text
+  conditional = options.get('http_cache', True) # revalidate text pages
+  if _fresh.get():
+    conditional = False
+
+  pages = run_context().pages if (cache and not binary) else None
+  fetched_body = None
+  if pages and not _fresh.get():
+    fetched_body = pages.get(page_key("GET", url))
 
   # check cache first
   if destination and cache and os.path.exists(destination):
@@ -279,6 +525,13 @@ def download(url, destination=None, options=None, scraper_slug=None):
     with open(destination, 'r', encoding='utf-8') as f:
       body = f.read()
 
+  # then pages already fetched during this run
+  elif fetched_body is not None:
+    logging.info("## Already fetched: %s" % url)
+    body = fetched_body
+    if destination:
+      write(body, destination, binary=binary)
+
   # otherwise, download from the web
   else:
 
@@ -294,7 +547,8 @@ def download(url, destination=None, options=None, scraper_slug=None):
         mkdir_p(os.path.dirname(destination))
 
         verify_options = domain_verify_options(url)
-        scraper.urlretrieve(url, destination, verify=verify_options)
+        if not download_binary(url, destination, verify=verify_options):
+          return None
       except connection_errors() as e:
         admin.log_http_error(e, url, scraper_slug)
         return None
@@ -310,7 +564,10 @@ def download(url, destination=None, options=None, scraper_slug=None):
         # provided by scrapelib.
 
         verify_options = domain_verify_options(url)
-        response = scraper.get(url, verify=verify_options)
+        if conditional:
+          response = conditional_get(url, verify=verify_options)
+        else:
+          response = scraper.get(url, verify=verify_options)
 
       except connection_errors() as e:
         admin.log_http_error(e, url, scraper_slug)
@@ -328,6 +585,14 @@ def download(url, destination=None, options=None, scraper_slug=None):
       if (not body) or (not body.strip()):
         return None
 
+      pattern = soft_404_pattern_for(url)
+      if pattern and pattern.search(response.content, 0, SOFT_404_PEEK_BYTES):
+        logging.warn("## Soft 404, not saving: %s" % url)
+        return None
+
+      if pages:
+        pages.put(page_key("GET", url), body, len(body))
+
       # cache content to disk
       if destination:
         write(body, destination, binary=binary)
@@ -339,24 +604,257 @@ def download(url, destination=None, options=None, scraper_slug=None):
     # whether from disk or web, unescape HTML entities
     return unescape(body)
 
-def beautifulsoup_from_url(url):
-  caller_filename = inspect.stack()[1][1]
-  caller_scraper = os.path.splitext(os.path.basename(caller_filename))[0]
+# small enough that a connection dropping mid-chunk loses little, since a
+# partly read chunk never reaches the .part
+DOWNLOAD_CHUNK_BYTES = 64 * 1024
+MAX_DOWNLOAD_RESUMES = 5
+CONTENT_RANGE_RE = re.compile(r"^bytes (\d+)-\d+/(\d+|\*)$")
+UNSATISFIED_RANGE_RE = re.compile(r"^bytes \*/(\d+)$")
+
+# Stream a binary file to destination. It's written to destination.part
+# first, and only renamed into place once complete, so an interrupted
+# download is never mistaken for a finished one. If the connection drops,
+# the download picks up where it left off with a Range request (when the
+# server supports them), including a .part left behind by an earlier run.
+# The file's ETag or Last-Modified is kept next to the .part and sent as
+# If-Range, so a file that changed in the meantime is fetched from scratch.
+# A .part that was complete already (the server answers 416) is used as is.
+# Returns False if what came back was a soft 404.
+def download_binary(url, destination, verify=True):
+  part_path = destination + ".part"
+  validator_path = part_path + ".validator"
+  resumes = 0
+  while True:
+    offset = os.path.getsize(part_path) if os.path.exists(part_path) else 0
+    before = offset
+    validator = None
+    if offset and os.path.exists(validator_path):
+      with open(validator_path, 'r', encoding='utf-8') as f:
+        validator = f.read().strip()
+    if validator:
+      headers = {"Range": "bytes=%d-" % offset, "If-Range": validator}
+    else:
+      headers = None
+    response = scraper.get(url, headers=headers, verify=verify, stream=True)
+    if response.status_code == 416:
+      response.close()
+      # the .part already reaches past the end of the file. if it's exactly
+      # the file's size, the last run finished writing it and just didn't
+      # get to rename it; otherwise it's no good, so start from scratch.
+      unsatisfied = UNSATISFIED_RANGE_RE.match(
+        response.headers.get("Content-Range", ""))
+      if unsatisfied and int(unsatisfied.group(1)) == offset:
+        break
+      logging.info("## Can't resume past the end, starting over: %s" % url)
+      os.remove(part_path)
+      os.remove(validator_path)
+      continue
+
+    expected = None
+    content_range = CONTENT_RANGE_RE.match(response.headers.get("Content-Range", ""))
+    if offset and response.status_code == 206 and content_range and \
+        int(content_range.group(1)) == offset:
+      mode = 'ab'
+      if content_range.group(2) != "*":
+        expected = int(content_range.group(2))
+    else:
+      # a fresh start, or the server ignored the Range header
+      if offset:
+        logging.info("## Can't resume, starting over: %s" % url)
+      mode = 'wb'
+      offset = 0
+      if response.headers.get("Content-Length") and \
+          not response.headers.get("Content-Encoding"):
+        expected = int(response.headers["Content-Length"])
+
+      # If-Range needs a strong ETag
+      validator = response.headers.get("ETag")
+      if (not validator) or validator.startswith("W/"):
+        validator = response.headers.get("Last-Modified")
+      if validator:
+        write(validator, validator_path)
+      elif os.path.exists(validator_path):
+        os.remove(validator_path)
+
+    try:
+      with open(part_path, mode) as f:
+        for chunk in response.iter_content(DOWNLOAD_CHUNK_BYTES):
+          f.write(chunk)
+          stats.count("bytes", len(chunk))
+      complete = (expected is None) or (os.path.getsize(part_path) >= expected)
+    except (requests.exceptions.ConnectionError,
+            requests.exceptions.ChunkedEncodingError,
+            requests.exceptions.Timeout) as exc:
+      logging.warn("## Download interrupted at %i bytes: %s (%s)" %
+                   (os.path.getsize(part_path), url, exc))
+      complete = False
+    finally:
+      response.close()
+
+    if complete:
+      break
+    # only attempts that didn't get any further count against the limit, so
+    # a big file on a flaky connection gets there a piece at a time
+    if os.path.getsize(part_path) > before:
+      resumes = 0
+    resumes += 1
+    if resumes > MAX_DOWNLOAD_RESUMES:
+      raise requests.exceptions.ConnectionError(
+        "Gave up on %s after %i attempts to resume without progress" %
+        (url, MAX_DOWNLOAD_RESUMES))
+
+  if os.path.exists(validator_path):
+    os.remove(validator_path)
+
+  # e.g. an HTML error page served in place of a PDF
+  pattern = soft_404_pattern_for(url)
+  if pattern and file_matches_soft_404(part_path, pattern):
+    logging.warn("## Soft 404, not saving: %s" % url)
+    os.remove(part_path)
+    return False
+
+  os.replace(part_path, destination)
+  return True
+
+_http_cache = None
+
+# the on-disk HTTP cache, or None if it's been turned off in admin.yml
+def http_cache():
+  global _http_cache
+  if admin.config and admin.config.get('http_cache') is False:
+    return None
+  # recorded fixtures should hold full responses, not 304s
+  if scraper.fixtures:
+    return None
+  if _http_cache is None:
+    config = admin.config and admin.config.get('http_cache')
+    config = config if isinstance(config, dict) else {}
+    _http_cache = httpcache.HttpCache(
+      os.path.join(cache_dir(), "http"),
+      int(config.get('max_age_days', httpcache.DEFAULT_MAX_AGE_DAYS)))
+    _http_cache.prune()
+  return _http_cache
+
+# GET a page, sending validators from the HTTP cache if we've seen it before.
+# A 304 comes back looking like the original 200, with the cached body.
+def conditional_get(url, **kwargs):
+  cache = http_cache()
+  entry = cache.get(url) if cache else None
+  headers = cache.conditional_headers(entry) if entry else None
+
+  response = scraper.get(url, headers=headers, **kwargs)
+
+  if entry and response.status_code == 304:
+    logging.info("## Not modified: %s" % url)
+    cache.restore(entry, response)
+  elif cache:
+    cache.store(url, response)
+  return response
+
+# parse_only takes a bs4.SoupStrainer, to only build the parts of a big
+# page that a scraper actually looks at. (If it leaves out <meta> tags, meta
+# refreshes won't be followed.)
+def beautifulsoup_from_url(url, parse_only=None):
+  caller_scraper = calling_scraper()
 
   body = download(url, scraper_slug=caller_scraper)
+  return beautifulsoup_from_body(url, body, caller_scraper, parse_only)
+
+def beautifulsoup_from_body(url, body, scraper_slug=None, parse_only=None):
   if body is None: return None
 
-  doc = BeautifulSoup(body, "lxml")
+  with stats.timer("parse_seconds"):
+    doc = BeautifulSoup(body, "lxml", parse_only=parse_only)
 
   # Some of the pages will return meta refreshes
   if doc.find("meta") and doc.find("meta").attrs.get('http-equiv') == 'REFRESH':
     redirect_url = urljoin(url, doc.find("meta").attrs['content'].split("url=")[1])
-    return beautifulsoup_from_url(redirect_url)
+    redirect_body = download(redirect_url, scraper_slug=scraper_slug)
+    return beautifulsoup_from_body(redirect_url, redirect_body, scraper_slug,
+                                   parse_only)
   else:
     return doc
 
+# Faster alternative to beautifulsoup_from_url for big pages: returns an
+# lxml.html tree instead, which supports the same CSS selectors through
+# doc.cssselect("div.listing a") (this needs the cssselect package). Links
+# can be made absolute with doc.make_links_absolute().
+#
+# Parsed trees are kept in the run's page cache too, and the cached tree
+# itself is what's handed out, so don't modify it (make_links_absolute
+# included) unless you ask for a copy of your own with mutable=True.
+def lxml_from_url(url, mutable=False):
+  caller_scraper = calling_scraper()
+
+  pages = run_context().pages
+  doc = None
+  if pages and not _fresh.get():
+    doc = pages.get(page_key("lxml", url))
+  if doc is None:
+    body = download(url, scraper_slug=caller_scraper)
+    doc = lxml_from_body(url, body, caller_scraper)
+    if (doc is None) or (not pages):
+      return doc
+    pages.put(page_key("lxml", url), doc, len(body))
+  if mutable:
+    return copy.deepcopy(doc)
+  return doc
+
+def lxml_from_body(url, body, scraper_slug=None):
+  if (body is None) or (not body.strip()): return None
+
+  with stats.timer("parse_seconds"):
+    try:
+      doc = lxml.html.document_fromstring(body, base_url=url)
+    except ValueError:
+      # lxml won't take a str that declares its own encoding. as bytes, it
+      # would believe the declaration, so say they're the UTF-8 they are
+      parser = lxml.html.HTMLParser(encoding="utf-8")
+      doc = lxml.html.document_fromstring(body.encode("utf-8"), parser=parser,
+                                          base_url=url)
+
+  # Some of the pages will return meta refreshes
+  meta = next(doc.iter("meta"), None)
+  if meta is not None and meta.get("http-equiv") == "REFRESH":
+    redirect_url = urljoin(url, meta.get("content").split("url=")[1])
+    redirect_body = download(redirect_url, scraper_slug=scraper_slug)
+    return lxml_from_body(redirect_url, redirect_body, scraper_slug)
+  else:
+    return doc
+
+# fetch many pages concurrently (see fetch.py), returns {url: body}, with
+# None for pages that couldn't be fetched. bodies are the same as download's.
+def fetch_many(urls, limit=None, options=None):
+  caller_scraper = calling_scraper()
+
+  def fetch_one(url):
+    return download(url, options=options, scraper_slug=caller_scraper)
+  return fetch.fetch_many(urls, fetch_one, limit)
+
+# like beautifulsoup_from_url for many pages at once, returns {url: doc}
+def beautifulsoups_from_urls(urls, limit=None, parse_only=None):
+  caller_scraper = calling_scraper()
+
+  def fetch_one(url):
+    return download(url, scraper_slug=caller_scraper)
+  bodies = fetch.fetch_many(urls, fetch_one, limit)
+
+  docs = {}
+  for url, body in bodies.items():
+    docs[url] = beautifulsoup_from_body(url, body, caller_scraper, parse_only)
+  return docs
+
 def post(url, data=None, headers=None, **kwargs):
+  pages = run_context().pages
+  key = page_key("POST", url, urllib.parse.urlencode(data, doseq=True)
+                 if isinstance(data, dict) else data)
   response = None
+  if pages and not _fresh.get():
+    response = pages.get(key)
+  if response is not None:
+    logging.info("## Already fetched: %s" % url)
+    return response
+
   try:
     verify_options = domain_verify_options(url)
     response = scraper.post(url, data=data, headers=headers, verify=verify_options)
@@ -364,6 +862,9 @@ def post(url, data=None, headers=None, **kwargs):
     admin.log_http_error(e, url)
     return None
 
+  if pages:
+    pages.put(key, response, len(response.content))
+
   return response
 
 def resolve_redirect(url):
@@ -422,13 +923,184 @@ def check_tool_present(*args):
   _tool_present_cache[args] = result
   return result
 
+# Limits for the external tools used to extract text and metadata, so that
+# one pathological file can't hang or exhaust a whole run. Configured under
+# `extraction` in admin.yml.
+DEFAULT_TOOL_TIMEOUT = 600 # seconds
+
+def tool_limits():
+  settings = (admin.config or {}).get('extraction') or {}
+  return (settings.get('timeout', DEFAULT_TOOL_TIMEOUT),
+          settings.get('memory_limit_mb'))
+
+def tool_command(args):
+  timeout, memory_limit_mb = tool_limits()
+  if memory_limit_mb:
+    # ulimit in a wrapper shell rather than a preexec_fn, which isn't safe to
+    # use from the save pipeline's threads
+    args = ["sh", "-c", 'ulimit -v %d && exec "$@"' % (int(memory_limit_mb) * 1024),
+            "sh"] + list(args)
+  return args, timeout
+
+def tool_call(args, **kwargs):
+  args, timeout = tool_command(args)
+  return subprocess.check_call(args, shell=False, timeout=timeout, **kwargs)
+
+def tool_output(args, **kwargs):
+  args, timeout = tool_command(args)
+  return subprocess.check_output(args, shell=False, timeout=timeout, **kwargs)
+
+def tool_errors():
+  return (subprocess.CalledProcessError, subprocess.TimeoutExpired)
+
 # read PDF's directory to determine if we need to decrypt it
 def check_pdf_decryption(pdf_path):
+  return inspect_pdf(pdf_path)['encrypted']
+
+PDF_INFO_FIELDS = (
+  ("/Title", "title"),
+  ("/Keywords", "keywords"),
+  ("/Author", "author"),
+)
+PDF_INFO_DATE_RE = re.compile("^(?:D:)?([0-9]{4})([0-9]{2})?([0-9]{2})?")
+PDF_INSPECTION_CACHE_SIZE = 256
+
+pdf_inspections = collections.OrderedDict()
+pdf_inspections_lock = threading.Lock()
+
+# everything we need to know about a PDF from a single pdfrw parse: whether
+# it's encrypted, (if it isn't) the same metadata pdfinfo would give us, and
+# the names of any files attached to it. 'metadata' is None when the file has
+# to go through pdfinfo instead, and 'attachments' is None if it couldn't be
+# read at all.
+#
+# results are cached by path, size and mtime, so extract_metadata and
+# extract_report share one parse of each file.
+def inspect_pdf(real_pdf_path):
+  stat = os.stat(real_pdf_path)
+  key = (os.path.abspath(real_pdf_path), stat.st_size, stat.st_mtime)
+  with pdf_inspections_lock:
+    if key in pdf_inspections:
+      pdf_inspections.move_to_end(key)
+      return pdf_inspections[key]
+
+  inspection = read_pdf(real_pdf_path)
+
+  with pdf_inspections_lock:
+    pdf_inspections[key] = inspection
+    while len(pdf_inspections) > PDF_INSPECTION_CACHE_SIZE:
+      pdf_inspections.popitem(last=False)
+  return inspection
+
+def read_pdf(real_pdf_path):
   try:
-    doc = pdfrw.PdfReader(pdf_path)
-    return "/Encrypt" in doc
-  except:
-    return False
+    doc = pdfrw.PdfReader(real_pdf_path, verbose=False)
+  except Exception:
+    return {'encrypted': False, 'metadata': None, 'attachments': None}
+
+  encrypted = "/Encrypt" in doc
+  try:
+    attachments = pdf_attachments(doc, encrypted)
+  except Exception:
+    attachments = None
+
+  if encrypted:
+    return {'encrypted': True, 'metadata': None, 'attachments': attachments}
+
+  try:
+    metadata = {}
+    page_count = doc.Root.Pages.Count
+    if page_count is not None:
+      metadata['page_count'] = int(page_count)
+
+    info = doc.Info or pdfrw.PdfDict()
+    if info.CreationDate:
+      metadata['creation_date'] = parse_pdf_info_date(pdf_string(info.CreationDate))
+    if info.ModDate:
+      metadata['modification_date'] = parse_pdf_info_date(pdf_string(info.ModDate))
+    for key, field in PDF_INFO_FIELDS:
+      if info.get(key):
+        metadata[field] = pdf_string(info[key])
+  except Exception:
+    # malformed page tree or info dictionary, let pdfinfo have a go
+    return {'encrypted': False, 'metadata': None, 'attachments': attachments}
+
+  return {'encrypted': False, 'metadata': metadata or None,
+          'attachments': attachments}
+
+# names of the files embedded in a PDF, from the document's /EmbeddedFiles
+# name tree and from file attachment annotations on its pages. strings in an
+# encrypted PDF are encrypted too, so its attachments are only numbered.
+def pdf_attachments(doc, encrypted=False):
+  filespecs = []
+  names = doc.Root.Names
+  if names and names.EmbeddedFiles:
+    filespecs.extend(pdf_name_tree_values(names.EmbeddedFiles))
+  for page in doc.pages:
+    for annotation in page.Annots or []:
+      if annotation and annotation.Subtype == "/FileAttachment" and annotation.FS:
+        filespecs.append(annotation.FS)
+
+  attachments = []
+  for number, filespec in enumerate(filespecs, 1):
+    name = None if encrypted else pdf_filespec_name(filespec)
+    attachments.append(name or "attachment %i" % number)
+  return attachments
+
+# the values of a PDF name tree, in order
+def pdf_name_tree_values(node, seen=None):
+  seen = seen if seen is not None else set()
+  if (not isinstance(node, pdfrw.PdfDict)) or id(node) in seen:
+    return []
+  seen.add(id(node))
+
+  values = []
+  if node.Names:
+    values.extend(node.Names[1::2])
+  for kid in node.Kids or []:
+    values.extend(pdf_name_tree_values(kid, seen))
+  return values
+
+# a file specification is either a plain string, or a dictionary with the
+# file name in one of several keys, best first
+def pdf_filespec_name(filespec):
+  if isinstance(filespec, pdfrw.PdfDict):
+    for key in ("/UF", "/F", "/Unix", "/DOS", "/Mac"):
+      if filespec.get(key):
+        return pdf_string(filespec[key])
+    return None
+  if filespec:
+    return pdf_string(filespec)
+  return None
+
+def pdf_string(value):
+  if isinstance(value, pdfrw.PdfString):
+    return value.to_unicode()
+  return str(value)
+
+# dates in a PDF's info dictionary look like D:20150312093015-04'00'
+def parse_pdf_info_date(raw):
+  match = PDF_INFO_DATE_RE.match(raw.strip())
+  if not match:
+    logging.warn('Could not parse PDF date: %s' % raw)
+    return None
+  year, month, day = match.groups()
+  try:
+    my_datetime = datetime(int(year), int(month or 1), int(day or 1))
+  except ValueError:
+    logging.warn('Could not parse PDF date: %s' % raw)
+    return None
+  return datetime.strftime(my_datetime, '%Y-%m-%d')
+
+# hex SHA-256 digest of a file's contents
+def sha256_for(path):
+  hash = hashlib.sha256()
+  with open(path, 'rb') as f:
+    message = None
+    while message != b'':
+      message = f.read(1024 * 1024)
+      hash.update(message)
+  return hash.hexdigest()
 
 # uses qpdf to decrypt a PDF
 def decrypt_pdf(source_path, destination_path):
@@ -439,12 +1111,12 @@ def decrypt_pdf(source_path, destination_path):
     return False
 
   try:
-    subprocess.check_call(["qpdf",
-                           "--decrypt",
-                           source_path,
-                           destination_path], shell=False)
+    tool_call(["qpdf",
+               "--decrypt",
+               source_path,
+               destination_path])
     return True
-  except subprocess.CalledProcessError as exc:
+  except tool_errors() as exc:
     logging.warn("Error decrypting %s:\n\n%s" %
                  (source_path, format_exception(exc)))
     return False
@@ -463,14 +1135,17 @@ def text_from_pdf(real_pdf_path, real_text_path):
     return
 
   try:
-    subprocess.check_call(["pdftotext",
-                           "-layout",
-                           "-nopgbrk",
-                           real_pdf_path,
-                           real_text_path], shell=False)
-  except subprocess.CalledProcessError as exc:
+    tool_call(["pdftotext",
+               "-layout",
+               "-nopgbrk",
+               real_pdf_path,
+               real_text_path])
+  except tool_errors() as exc:
     logging.warn("Error extracting text to %s:\n\n%s" %
                  (real_text_path, format_exception(exc)))
+    # don't leave partial text behind to be mistaken for the real thing
+    if os.path.exists(real_text_path):
+      os.remove(real_text_path)
     return
 
   if not os.path.exists(real_text_path):
@@ -484,13 +1159,16 @@ def text_from_doc(real_doc_path, real_text_path):
     return
 
   try:
-    subprocess.check_call(["abiword",
-                           real_doc_path,
-                           "--to",
-                           "txt"], shell=False)
-  except subprocess.CalledProcessError as exc:
+    tool_call(["abiword",
+               real_doc_path,
+               "--to",
+               "txt"])
+  except tool_errors() as exc:
     logging.warn("Error extracting text to %s:\n\n%s" %
                  (real_text_path, format_exception(exc)))
+    # don't leave partial text behind to be mistaken for the real thing
+    if os.path.exists(real_text_path):
+      os.remove(real_text_path)
     return
 
   if not os.path.exists(real_text_path):
@@ -564,9 +1242,9 @@ def metadata_from_pdf(pdf_path):
   real_pdf_path = os.path.abspath(real_pdf_path)
 
   try:
-    output = subprocess.check_output(["pdfinfo", real_pdf_path], shell=False)
+    output = tool_output(["pdfinfo", real_pdf_path])
     output = output.decode('utf-8', errors='replace')
-  except subprocess.CalledProcessError as exc:
+  except tool_errors() as exc:
     logging.warn("Error extracting metadata for %s:\n\n%s" %
                  (pdf_path, format_exception(exc)))
     return None
@@ -639,9 +1317,9 @@ def metadata_from_doc(doc_path):
   real_doc_path = os.path.abspath(real_doc_path)
 
   try:
-    output = subprocess.check_output(["file", real_doc_path], shell=False)
+    output = tool_output(["file", real_doc_path])
     output = output.decode('utf-8', errors='replace')
-  except subprocess.CalledProcessError as exc:
+  except tool_errors() as exc:
     logging.warn("Error extracting metadata for %s:\n\n%s" %
                  (doc_path, format_exception(exc)))
     return None
@@ -714,9 +1392,20 @@ def data_dir():
     return admin.config.get('data_directory')
   return "data"
 
+# holds caches that aren't part of the output data, like the HTTP cache
+def cache_dir():
+  if admin.config and admin.config.get('cache_directory'):
+    return admin.config.get('cache_directory')
+  return "cache"
+
 def write(content, destination, binary=False):
   mkdir_p(os.path.dirname(destination))
 
+  # never write through a hardlink into the blob store (see blobs.py), that
+  # would change every report sharing the file
+  if os.path.isfile(destination) and os.stat(destination).st_nlink > 1:
+    os.remove(destination)
+
   if binary:
     f = open(destination, 'bw')
   else:
@@ -746,12 +1435,14 @@ def mkdir_p(path):
     else:
       raise
 
+ENTITY_RE = re.compile("&#?\w+;")
+UNICODE_CONTROL_RE = re.compile('[\x00-\x08\x0B-\x0C\x0E-\x1F\x7F]')
+
 # taken from http://effbot.org/zone/re-sub.htm#unescape-html
 def unescape(text):
 
   def remove_unicode_control(str):
-    remove_re = re.compile('[\x00-\x08\x0B-\x0C\x0E-\x1F\x7F]')
-    return remove_re.sub('', str)
+    return UNICODE_CONTROL_RE.sub('', str)
 
   def fixup(m):
     text = m.group(0)
@@ -772,7 +1463,7 @@ def unescape(text):
         pass
     return text # leave as is
 
-  text = re.sub("&#?\w+;", fixup, text)
+  text = ENTITY_RE.sub(fixup, text)
   text = remove_unicode_control(text)
   return text
 
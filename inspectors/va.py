@@ -14,6 +14,9 @@ archive = 1996
 # options:
 #   standard since/year options for a year range to fetch from.
 #
+#   skip_downloaded - skip the landing pages of reports that are already saved.
+#   stop_at_known - also stop paging once a whole page is already saved.
+#
 # Notes for IG's web team:
 #
 
@@ -65,7 +68,8 @@ def run(options):
     # look like this.
     url = "{}?RS={}".format(REPORTS_URL, page)
     for attempt in range(MAX_ATTEMPTS):
-      doc = utils.beautifulsoup_from_url(url)
+      with utils.fresh(attempt > 0):
+        doc = utils.beautifulsoup_from_url(url)
       if doc.select(".content")[0].text.strip():
         break
       time.sleep(30)
@@ -76,14 +80,18 @@ def run(options):
         raise inspector.NoReportsFoundError("VA (audit reports)")
       else:
         break
+    listing = inspector.ListingPage('va', options)
     for result in results:
-      report = report_from(result, year_range)
+      report = report_from(result, year_range, listing)
       if report:
         inspector.save_report(report)
+    if listing.all_known():
+      break
 
   # Pull the semiannual reports
   for attempt in range(MAX_ATTEMPTS):
-    doc = utils.beautifulsoup_from_url(SEMIANNUAL_REPORTS_URL)
+    with utils.fresh(attempt > 0):
+      doc = utils.beautifulsoup_from_url(SEMIANNUAL_REPORTS_URL)
     page_text = doc.select("div.single-column-report-list")[0].text.strip()
     if page_text != ERROR_TEXT_LIST:
       break
@@ -113,7 +121,7 @@ def report_type_from_topic(topic):
     return 'other'
 
 
-def report_from(result, year_range):
+def report_from(result, year_range, listing):
   link = result.select("a")[0]
   title = link.text
   landing_url = result.select("p.summary a")[0].get('href')
@@ -131,10 +139,14 @@ def report_from(result, year_range):
   if landing_url == 'https://www.va.gov/oig/publications/report-summary.asp?id=2491':
     return
 
+  if listing.skip_known(landing_url=landing_url):
+    return
+
   # These pages occassionally return text indicating there was a temporary
   # error so we will retry if necessary.
   for attempt in range(MAX_ATTEMPTS):
-    landing_page = utils.beautifulsoup_from_url(landing_url)
+    with utils.fresh(attempt > 0):
+      landing_page = utils.beautifulsoup_from_url(landing_url)
     page_text = landing_page.select("div.report-summary")[0].text.strip()
     if page_text != ERROR_TEXT_SUMMARY:
       break
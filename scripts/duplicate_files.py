@@ -1,52 +1,96 @@
 #!/usr/bin/env python
 
 import hashlib
-import os, os.path
-from inspectors.utils import utils
 import logging
+import os, os.path
+from inspectors.utils import utils, admin, corpus, filehashes
+
+# Besides printing each duplicate as it turns up, writes every group of
+# identical files to cache/qa/duplicate_files.json (or wherever
+# `duplicate_files_report` in admin.yml says), for other tools to read:
+#
+#   {"groups": [{"sha256": "...", "size": 1234, "files": ["data/...", ...]}]}
+#
+# Hashes are cached between runs (see utils/filehashes.py), so only new and
+# changed files are read.
+
+class DuplicateFiles(corpus.Check):
+  name = "duplicate_files"
+  reads_content = True
 
-class Deduplicator(object):
-  def __init__(self):
+  def __init__(self, options):
+    super(DuplicateFiles, self).__init__(options)
     self.hashes_to_names = {}
+    self.sizes = {}
+    self.cache = filehashes.HashCache(filehashes.cache_path())
+    self.new_hashes = []
+    self.seen = set()
 
-  def add_and_check_file(self, filename):
-    hash = self.file_to_hash(filename)
-    if hash in self.hashes_to_names:
-      self.hashes_to_names[hash].append(filename)
-      return self.hashes_to_names[hash]
-    else:
-      self.hashes_to_names[hash] = [filename]
+  def wants(self, inspector, path):
+    return True
+
+  def start_file(self, inspector, path):
+    try:
+      key = filehashes.stat_key(os.stat(path))
+    except OSError:
+      return None
+    real_path = os.path.abspath(path)
+    return {'path': real_path, 'key': key, 'hash': hashlib.sha256(),
+            'sha256': self.cache.lookup(real_path, key)}
+
+  def reads(self, inspector, path, state):
+    return bool(state) and not state['sha256']
+
+  def update(self, state, chunk):
+    state['hash'].update(chunk)
+
+  def end_file(self, inspector, path, state):
+    if not state:
       return None
+    if state['sha256']:
+      return state['path'], state['key'], state['sha256'], False
+    return state['path'], state['key'], state['hash'].hexdigest(), True
+
+  def collect(self, inspector, path, result):
+    real_path, key, sha256, new = result
+    self.seen.add(real_path)
+    if new:
+      self.new_hashes.append((real_path, key, sha256))
+
+    self.sizes[sha256] = key[0]
+    if sha256 in self.hashes_to_names:
+      self.hashes_to_names[sha256].append(path)
+      self.report("Duplicate files: " + ", ".join(self.hashes_to_names[sha256]))
+    else:
+      self.hashes_to_names[sha256] = [path]
+
+  def finish(self):
+    self.cache.store(self.new_hashes)
+    data_dir = os.path.abspath(utils.data_dir())
+    ig_list = self.options.get("inspectors")
+    for directory in ([os.path.join(data_dir, ig) for ig in ig_list] if ig_list else [data_dir]):
+      self.cache.prune(directory, self.seen)
+    logging.info("Hashed %i new or changed files" % len(self.new_hashes))
+
+    groups = []
+    for sha256, names in sorted(self.hashes_to_names.items()):
+      if len(names) > 1:
+        groups.append({'sha256': sha256, 'size': self.sizes[sha256], 'files': names})
+    utils.write(utils.json_for({'groups': groups}), report_path())
+
+def report_path():
+  if admin.config and admin.config.get('duplicate_files_report'):
+    return admin.config.get('duplicate_files_report')
+  return os.path.join(utils.cache_dir(), "qa", "duplicate_files.json")
 
-  def file_to_hash(self, path):
-    hash = hashlib.sha256()
-    with open(path, 'rb') as f:
-      message = None
-      while message != b'':
-        message = f.read(1024 * 1024)
-        hash.update(message)
-    return hash.digest()
+CHECK = DuplicateFiles
 
 def run(options):
-  ig_list = options.get("inspectors")
-
-  dedup = Deduplicator()
-  data_dir = utils.data_dir()
-  for inspector in os.listdir(data_dir):
-    if not ig_list or inspector in ig_list:
-      logging.debug("[%s] Checking..." % inspector)
-
-      inspector_path = os.path.join(data_dir, inspector)
-      if os.path.isdir(inspector_path):
-        for dirpath, dirnames, filenames in os.walk(inspector_path):
-          for filename in filenames:
-            result = dedup.add_and_check_file(os.path.join(dirpath, filename))
-            if result:
-              print("Duplicate files: " + ", ".join(result))
+  corpus.run_checks([DuplicateFiles(options)], options, utils.data_dir())
 
 def main():
   import sys, os, os.path
   sys.path.append(os.getcwd())
   sys.path.append(os.path.abspath(".."))
-  run([])
+  run({})
 main() if (__name__ == "__main__") else None
@@ -1,52 +1,36 @@
 #!/usr/bin/env python
 
-import os, os.path, subprocess, tempfile, shutil
-import logging
-from inspectors.utils import utils
+import os, os.path
+from inspectors.utils import utils, corpus
+
+# reads each PDF's embedded files and attachment annotations with pdfrw (see
+# utils.pdf_attachments), rather than unpacking them with qpdf and pdftk
+class PdfAttachments(corpus.Check):
+  name = "find_pdf_attachments"
+
+  def wants(self, inspector, path):
+    _, extension = os.path.splitext(path.lower())
+    return extension == ".pdf"
+
+  def end_file(self, inspector, path, state):
+    attachments = utils.read_pdf(path)['attachments']
+    if attachments is None:
+      return "Couldn't read %s" % path
+    if attachments:
+      return "%s has the following attachments: %s" % (path, ', '.join(attachments))
+    return None
+
+  def collect(self, inspector, path, message):
+    self.report(message)
+
+CHECK = PdfAttachments
 
 def run(options):
-  ig_list = options.get("inspectors")
-
-  data_dir = utils.data_dir()
-  for inspector in os.listdir(data_dir):
-    if not ig_list or inspector in ig_list:
-      logging.debug("[%s] Checking..." % inspector)
-
-      inspector_path = os.path.join(data_dir, inspector)
-      if os.path.isdir(inspector_path):
-        for dirpath, dirnames, filenames in os.walk(inspector_path):
-          for filename in filenames:
-            _, extension = os.path.splitext(filename.lower())
-            if extension == ".pdf":
-              try:
-                original = os.path.join(dirpath, filename)
-                decrypted_file, decrypted_path = tempfile.mkstemp(suffix=".pdf")
-                os.close(decrypted_file)
-                decrypted_file = None
-                logging.debug("Decrypting %s to %s" % (original, decrypted_path))
-                subprocess.check_call(["qpdf", "--decrypt", original, decrypted_path])
-                try:
-                  extract_dir = tempfile.mkdtemp()
-                  logging.debug("Extracting %s to %s" % (decrypted_path, extract_dir))
-                  subprocess.check_call(["pdftk", decrypted_path, "unpack_files"], cwd=extract_dir)
-                  attachments = os.listdir(extract_dir)
-                  if attachments:
-                    print("%s has the following attachments: %s" % (original, ', '.join(attachments)))
-                finally:
-                  shutil.rmtree(extract_dir)
-              except subprocess.CalledProcessError as e:
-                print(e)
-              finally:
-                try:
-                  if decrypted_file:
-                    os.close(decrypted_file)
-                    decrypted_file = None
-                finally:
-                  os.remove(decrypted_path)
+  corpus.run_checks([PdfAttachments(options)], options, utils.data_dir())
 
 def main():
   import sys, os, os.path
   sys.path.append(os.getcwd())
   sys.path.append(os.path.abspath(".."))
-  run([])
+  run({})
 main() if (__name__ == "__main__") else None
@@ -1,14 +1,13 @@
 #!/usr/bin/env python
 
+import json
 import os, os.path
-import re
-from inspectors.utils import utils
+from inspectors.utils import utils, corpus
 import logging
 import scrapelib
 
-PAGE_NOT_FOUND_PATTERN = b"(<title>(404 Page Not Found - CFTC|CPB: Page Not Found|DoD IG - Error Message|404: NOT FOUND|Page Not Found|Maintenance|Page Not Found Smithsonian|404)</title>|That page was not found\\.&#160; If possible we will redirect you to that content now\\.)"
-PAGE_NOT_FOUND_BYTES_RE = re.compile(PAGE_NOT_FOUND_PATTERN)
-PAGE_NOT_FOUND_STRING_RE = re.compile(PAGE_NOT_FOUND_PATTERN.decode('ascii'))
+# error pages are recognized by the same signatures downloads are checked
+# against, see utils.register_soft_404
 
 URLS = {
   'cftc': 'http://www.cftc.gov/About/OfficeoftheInspectorGeneral/doesyour404work',
@@ -22,53 +21,75 @@ URLS = {
 
 IGS_WITH_BAD_404 = tuple(URLS.keys())
 
-def run(options):
+# how much of the start of each saved page is scanned
+SCAN_BYTES = 64 * 1024
+
+# Only reports saved as HTML (by the file_type in their report.json) are
+# scanned, and only their first SCAN_BYTES, mapped into memory rather than
+# read. Downloads are checked too as they come in, see utils.download.
+class Soft404(corpus.Check):
+  name = "soft_404"
+
+  # make sure the soft-404 handlers still catch each IG's error page
+  def begin(self):
+    ig_list = self.options.get("inspectors")
+
+    for inspector, url in URLS.items():
+      if (not ig_list) or (inspector in ig_list):
+        logging.debug("[%s] Checking..." % inspector)
+        result = None
+        status_code_rewritten = False
+        while True:
+          try:
+            response = utils.scraper.get(url)
+            result = response.text
+            break
+          except scrapelib.HTTPError as e:
+            if e.response.status_code == 404:
+              status_code_rewritten = True
+              if 'location' in e.response.headers:
+                url = e.response.headers['location']
+                continue
+            result = e.body
+            break
+
+        if not status_code_rewritten:
+          self.report("False negative for %s (handler did not rewrite error "
+                      "code)" % inspector)
+
+        pattern = utils.soft_404_pattern_for(url)
+        if not (pattern and pattern.search((result or "").encode("utf-8"))):
+          self.report("False negative for %s (regular expression did not "
+                      "match error page contents)" % inspector)
 
-  ig_list = options.get("inspectors")
-
-  for inspector, url in URLS.items():
-    if (not ig_list) or (inspector in ig_list):
-      logging.debug("[%s] Checking..." % inspector)
-      result = None
-      status_code_rewritten = False
-      while True:
-        try:
-          response = utils.scraper.get(url)
-          result = response.text
-          break
-        except scrapelib.HTTPError as e:
-          if e.response.status_code == 404:
-            status_code_rewritten = True
-            if 'location' in e.response.headers:
-              url = e.response.headers['location']
-              continue
-          result = e.body
-          break
-
-      if not status_code_rewritten:
-        print("False negative for %s (handler did not rewrite error code)" %
-              inspector)
-
-      match = PAGE_NOT_FOUND_STRING_RE.search(result)
-      if not match:
-        print("False negative for %s (regular expression did not match error "
-              "page contents)" % inspector)
-
-  data_dir = utils.data_dir()
-  for inspector in os.listdir(data_dir):
-    if (not ig_list or inspector in ig_list) and inspector in IGS_WITH_BAD_404:
-      inspector_path = os.path.join(data_dir, inspector)
-      if os.path.isdir(inspector_path):
-        for dirpath, dirnames, filenames in os.walk(inspector_path):
-          for filename in filenames:
-            path = os.path.join(dirpath, filename)
-            try:
-              f = open(path, 'r', encoding='utf-8')
-              for line in f:
-                if PAGE_NOT_FOUND_STRING_RE.search(line):
-                  print("Soft 404 found: %s" % path)
-            except UnicodeDecodeError:
-              f = open(path, 'rb')
-              for line in f:
-                if PAGE_NOT_FOUND_BYTES_RE.search(line):
-                  print("Soft 404 found: %s" % path)
+  def wants(self, inspector, path):
+    return inspector in IGS_WITH_BAD_404 and \
+      os.path.basename(path) == "report.json"
+
+  # given a report.json, returns the path of a saved soft 404, if it is one
+  def end_file(self, inspector, path, state):
+    try:
+      with open(path, 'r', encoding='utf-8') as f:
+        report = json.load(f)
+    except (OSError, ValueError):
+      return None
+    file_type = report.get('file_type')
+    if (not file_type) or (file_type.lower() not in utils.FILE_EXTENSIONS_HTML):
+      return None
+    pattern = utils.soft_404_pattern_for(report.get('url') or "")
+    if not pattern:
+      return None
+
+    report_path = os.path.join(os.path.dirname(path), "report.%s" % file_type)
+    if os.path.isfile(report_path) and \
+        utils.file_matches_soft_404(report_path, pattern, SCAN_BYTES):
+      return report_path
+    return None
+
+  def collect(self, inspector, path, report_path):
+    self.report("Soft 404 found: %s" % report_path)
+
+CHECK = Soft404
+
+def run(options):
+  corpus.run_checks([Soft404(options)], options, utils.data_dir())
@@ -1,41 +1,41 @@
 #!/usr/bin/env python
 
-import sys, os, os.path, json
-from inspectors.utils import utils
+import sys, os, os.path
+from inspectors.utils import utils, manifest, corpus
 import logging
 
-def run(options):
-  data_dir = utils.data_dir()
-  ig_list = options.get("inspectors")
-
-  report_id_history = {}
-  for inspector in os.listdir(data_dir):
-    logging.debug("[%s] Checking..." % inspector)
-
-    if not ig_list or inspector in ig_list:
-      inspector_path = os.path.join(data_dir, inspector)
-      if os.path.isdir(inspector_path):
-        for year in os.listdir(inspector_path):
-          year_path = os.path.join(inspector_path, year)
-          if os.path.isdir(year_path):
-            for report in os.listdir(year_path):
-              report_path = os.path.join(year_path, report)
-              if os.path.isdir(report_path):
-                json_path = os.path.join(report_path, "report.json")
-                if os.path.isfile(json_path):
-                  report_data = json.load(open(json_path, "r", encoding="utf-8"))
-                  report_id = report_data["report_id"]
-                  if report_id in report_id_history:
-                    report_id_history[report_id].append(json_path)
-                    print("Duplicate report_id %s in %s" % (repr(report_id), ", ".join(report_id_history[report_id])))
-                  else:
-                    report_id_history[report_id] = [json_path]
-        if "global" not in options:
+# reads the manifest rather than walking the data directory
+class UniqueReportIds(corpus.Check):
+  name = "unique_report_ids"
+
+  def finish(self):
+    data_dir = utils.data_dir()
+    ig_list = self.options.get("inspectors")
+    index = manifest.get_manifest()
+
+    report_id_history = {}
+    for inspector in index.inspectors():
+      logging.debug("[%s] Checking..." % inspector)
+
+      if not ig_list or inspector in ig_list:
+        for _, year, report_id in index.reports(inspector, statuses=manifest.SAVED_STATUSES):
+          json_path = os.path.join(data_dir, inspector, str(year), report_id, "report.json")
+          if report_id in report_id_history:
+            report_id_history[report_id].append(json_path)
+            self.report("Duplicate report_id %s in %s" % (repr(report_id), ", ".join(report_id_history[report_id])))
+          else:
+            report_id_history[report_id] = [json_path]
+        if "global" not in self.options:
           report_id_history = {}
 
+CHECK = UniqueReportIds
+
+def run(options):
+  corpus.run_checks([UniqueReportIds(options)], options, utils.data_dir())
+
 def main():
   sys.path.append(os.getcwd())
   sys.path.append(os.path.abspath(".."))
-  run([]) #?
+  run({})
 
 main() if (__name__ == "__main__") else None